@@ -0,0 +1,141 @@
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A persistent cache of compiled BMV2 JSON files, keyed on the contents of the
+# program and everything that can influence the compiler's output.
+
+import errno
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+
+INCLUDE_RE = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+def find_includes(path, include_dirs):
+    # Return the program and every file it (transitively) includes that we can
+    # find. Includes we can't resolve (e.g. core.p4 or v1model.p4) ship with
+    # the compiler, so they're covered by the compiler's identity instead.
+    found = []
+    pending = [os.path.abspath(path)]
+    while pending:
+        current = pending.pop()
+        if current in found: continue
+        found.append(current)
+        with open(current, 'r') as f:
+            text = f.read()
+        search_dirs = [os.path.dirname(current)] + include_dirs
+        for name in INCLUDE_RE.findall(text):
+            for d in search_dirs:
+                candidate = os.path.abspath(os.path.join(d, name))
+                if os.path.isfile(candidate):
+                    pending.append(candidate)
+                    break
+    return found
+
+def include_dirs_from_flags(flags):
+    dirs = []
+    tokens = ' '.join(flags).split()
+    for i, token in enumerate(tokens):
+        if token == '-I' and i + 1 < len(tokens):
+            dirs.append(tokens[i + 1])
+        elif token.startswith('-I') and len(token) > 2:
+            dirs.append(token[2:])
+    return [os.path.abspath(d) for d in dirs]
+
+def compiler_identity(compiler):
+    # Identify the compiler by its resolved path, size and modification time.
+    # That changes whenever the compiler is rebuilt or the image is updated,
+    # and is much cheaper than hashing the binary on every run.
+    path = find_executable(compiler) or compiler
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return '%s:%d:%d' % (path, st.st_size, int(st.st_mtime))
+
+def compile_key(program_file, language, flags, compiler):
+    h = hashlib.sha1()
+    h.update('language:%s\n' % language)
+    h.update('compiler:%s\n' % compiler_identity(compiler))
+    for flag in flags:
+        h.update('flag:%s\n' % flag)
+
+    program_path = os.path.abspath(program_file)
+    for path in sorted(find_includes(program_file, include_dirs_from_flags(flags))):
+        # Key on paths relative to the program so that the same package
+        # extracted into a different build directory still hits.
+        h.update('file:%s\n' % os.path.relpath(path, os.path.dirname(program_path)))
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha1(f.read()).hexdigest())
+    return h.hexdigest()
+
+class CompileCache:
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, program_file, language, flags, compiler):
+        return compile_key(program_file, language, flags, compiler)
+
+    def entryPath(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def lookup(self, key, output_file):
+        entry = self.entryPath(key)
+        if not os.path.isfile(entry):
+            return False
+        shutil.copyfile(entry, output_file)
+        # Bump the modification time: that's what eviction orders entries by.
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, output_file):
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+
+        # Write to a temporary file and rename it into place, so that readers
+        # never see a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(output_file, tmp_path)
+        os.rename(tmp_path, self.entryPath(key))
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'): continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # removed concurrently
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
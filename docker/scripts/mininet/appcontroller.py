@@ -1,6 +1,19 @@
-import subprocess
-
+import os
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from apppoller import AppPoller
+from apptimings import monotonic
+from entryfile import EntryFile, BmMatchParam, EXTENSION as ENTRY_FILE_EXTENSION
+from hostroutes import aggregateRoutes, classfulPrefixLen
+from mcasttree import spanningTree, pruneTree
 from shortest_path import ShortestPath
+from snapshots import toColumn
+from switchsession import SwitchSession, parseCliOutput, arrayNames, findArray
+from switchstate import TableState, InstalledTables, InstalledSelector, planMcastGroups
 
 def isInt(s):
     try:
@@ -9,6 +22,22 @@ def isInt(s):
     except ValueError:
         return False
 
+# How many table_add commands to send per CLI process, when the entries of an
+# entry file can't be sent over Thrift directly.
+ENTRY_FILE_BATCH = 10000
+
+def linkNhop(port):
+    # A made-up next hop address that identifies a switch's egress port.
+    return '169.254.%d.%d' % (port >> 8, port & 0xff)
+
+def firstError(results):
+    # The first error in the results of some commands. A missing result (the
+    # CLI stopped before the command) counts as one.
+    for result in results:
+        if result is None: return 'no output'
+        if 'error' in result: return result['error']
+    return None
+
 class AppController:
 
     def __init__(self, manifest=None, target=None, topo=None, net=None, cli_path='simple_switch_CLI'):
@@ -24,12 +53,51 @@ class AppController:
 
         self.command_files = dict((sw, []) for sw in self.switches)
         self.commands = dict((sw, []) for sw in self.switches)
+        # Binary entry files are streamed into the switches once, as they are.
+        self.entry_files = dict((sw, []) for sw in self.switches)
+        self.loaded_entry_files = dict((sw, set()) for sw in self.switches)
 
         self.mcast_groups_files = dict((sw, []) for sw in self.switches)
         self.mcast_groups = dict((sw, {}) for sw in self.switches)
         self.last_mcnoderid = 0
 
+        # What has actually been installed on each switch, so that only the
+        # differences need to be sent when the configuration changes.
+        self.installed = dict((sw, InstalledTables()) for sw in self.switches)
+        self.installed_mcast = dict((sw, {}) for sw in self.switches) # mgid -> (handle, ports)
+
+        # With ECMP, ipv4_lpm has an action selector: each destination maps to
+        # the set_nhop members for all of its equal-cost next hops.
+        self.ecmp = bool(self.conf.get('ecmp', False))
+        self.selectors = dict((sw, InstalledSelector('ipv4_lpm')) for sw in self.switches)
+
         self.shortestpath = ShortestPath(self.conf['links'])
+        # Paths between hosts never go through other hosts. This is always
+        # the same object, so ShortestPath can reuse the trees it computes.
+        self.isHost = lambda n: n in self.topo._host_links
+
+        # The generated commands (and, with ECMP, routes) for reaching each
+        # host, so that they can be recomputed for just the hosts affected by
+        # a link going up or down.
+        self.host_commands = {} # h_name -> sw_name -> [commands]
+        self.host_routes = {}   # h_name -> sw_name -> prefix -> [(action, params)]
+
+        # sw_name -> (start, end) of loading that switch's commands
+        self.load_times = {}
+        # One entry for each link that went up or down while we were running.
+        self.link_events = []
+
+        # thrift_port -> SwitchSession, kept open until stop()
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+        # How many switches (or hosts) to configure at once. The pool is shared
+        # by both, so it is sized for whichever there are more of.
+        nodes = max(len(self.switches), len(self.topo._host_links))
+        self.workers = int(self.conf.get('control_plane_workers', min(nodes, 32)))
+        self.pool = None
+
+        self.poller = None
 
 
     def readCommands(self, filename):
@@ -43,21 +111,51 @@ class AppController:
         return commands
 
     def parseCliOutput(self, s):
-        parsed = dict(raw=s)
-        if 'created with handle' in s:
-            parsed['handle'] = int(s.split('created with handle', 1)[-1].split()[0])
-        return parsed
+        return parseCliOutput(s)
+
+    def getSession(self, sw=None, thrift_port=9090):
+        "The control-plane session for a switch (a name or a node), opened on first use."
+        if sw is not None:
+            if isinstance(sw, basestring): sw = self.net.get(sw)
+            thrift_port = sw.thrift_port
+        with self.lock:
+            if thrift_port not in self.sessions:
+                self.sessions[thrift_port] = SwitchSession(thrift_port, cli_path=self.cli_path,
+                                                           json_path=getattr(sw, 'json_path', None))
+            return self.sessions[thrift_port]
+
+    def forEach(self, items, fn, what):
+        # Call fn(item) for every item on a pool of self.workers threads, and
+        # wait for all of them to finish. Failures are reported per item.
+        errors = {}
+        def run(item):
+            try:
+                fn(item)
+            except Exception:
+                errors[item] = traceback.format_exc()
+
+        # The pool is kept until stop(): starting and joining one for every
+        # call adds ~100ms, which matters when rerouting around a failure.
+        if self.pool is None:
+            self.pool = ThreadPool(max(1, self.workers))
+        self.pool.map(run, items)
+
+        if errors:
+            for item in sorted(errors):
+                print 'Error while %s %s:' % (what, item)
+                print errors[item]
+            raise Exception('Failed %s %s' % (what, ', '.join(sorted(errors))))
 
     def sendCommands(self, commands, thrift_port=9090, sw=None):
-        if sw: thrift_port = sw.thrift_port
-
-        print '\n'.join(commands)
-        p = subprocess.Popen([self.cli_path, '--thrift-port', str(thrift_port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, nostderr = p.communicate(input='\n'.join(commands))
-        print stdout
-        raw_results = stdout.split('RuntimeCmd:')[1:len(commands)+1]
-        parsed_results = map(self.parseCliOutput, raw_results)
-        return parsed_results
+        results = self.getSession(sw, thrift_port).run(commands)
+        # Print everything at once, so that the output for switches being
+        # configured concurrently doesn't interleave.
+        output = ['\n'.join(commands)]
+        for result in results:
+            output.append(result['raw'].rstrip('\n'))
+            if 'error' in result: output.append(result['error'])
+        print '\n'.join(output) + '\n'
+        return results
 
     def readMcastGroups(self, filename, sw):
         def portForStr(s):
@@ -76,61 +174,260 @@ class AppController:
         return groups
 
     def createMcastGroup(self, mgid, ports, sw=None):
-        self.last_mcnoderid += 1
-        commands = ['mc_node_create %d %s' % (self.last_mcnoderid, ' '.join(map(str, ports)))]
+        return self.createMcastGroups({mgid: ports}, sw=sw)[mgid]
+
+    def createMcastGroups(self, groups, sw=None):
+        # Creates the groups (mgid -> ports). Returns mgid -> node handle.
+        _, handles, errors = self.sendMcastCommands(groups, sw=sw)
+        if errors: raise Exception('; '.join(errors))
+        return handles
+
+    def sendMcastCommands(self, groups, sw=None, before=[]):
+        # Creates the groups (mgid -> ports) with two batches of commands: one
+        # for the nodes, which also runs the commands in `before`, and one for
+        # the groups, which need the nodes' handles. Returns the results of
+        # `before`, mgid -> node handle for the groups that were created, and
+        # the errors for the ones that weren't.
+        mgids = sorted(groups)
+        with self.lock:
+            rids = range(self.last_mcnoderid + 1, self.last_mcnoderid + 1 + len(mgids))
+            self.last_mcnoderid += len(mgids)
+        commands = list(before) + ['mc_node_create %d %s' % (rid, ' '.join(map(str, groups[mgid])))
+                                   for rid, mgid in zip(rids, mgids)]
+        if not commands: return [], {}, []
         results = self.sendCommands(commands, sw=sw)
+        before_results, results = results[:len(before)], results[len(before):]
 
-        handle = results[-1]['handle']
-        commands = ['mc_mgrp_create %d' % mgid]
-
-        if 'model' in self.conf and self.conf['model'].lower() != 'bmv2':
-            commands += ['mc_associate_node %d %d 0 0' % (mgid, results[-1]['handle'])]
-        else:
-            commands += ['mc_node_associate %d %d' % (mgid, results[-1]['handle'])]
-
-        self.sendCommands(commands, sw=sw)
+        handles, errors = {}, []
+        created = [] # (mgid, node handle, commands)
+        for mgid, result in zip(mgids, results):
+            if 'handle' not in result:
+                errors.append('Could not create a multicast node for group %d: %s' % (mgid, result.get('error', result['raw'])))
+                continue
+            commands = ['mc_mgrp_create %d' % mgid]
+            if 'model' in self.conf and self.conf['model'].lower() != 'bmv2':
+                commands.append('mc_associate_node %d %d 0 0' % (mgid, result['handle']))
+            else:
+                commands.append('mc_node_associate %d %d' % (mgid, result['handle']))
+            created.append((mgid, result['handle'], commands))
+        if not created: return before_results, handles, errors
+
+        results = iter(self.sendCommands(sum([c for _, _, c in created], []), sw=sw))
+        for mgid, handle, commands in created:
+            error = firstError([next(results, None) for _ in commands])
+            if error:
+                errors.append('Could not create multicast group %d: %s' % (mgid, error))
+            else:
+                handles[mgid] = handle
+        return before_results, handles, errors
 
     def readRegister(self, register, idx, thrift_port=9090, sw=None):
-        if sw: thrift_port = sw.thrift_port
-        p = subprocess.Popen([self.cli_path, '--thrift-port', str(thrift_port)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(input="register_read %s %d" % (register, idx))
-        reg_val = filter(lambda l: ' %s[%d]' % (register, idx) in l, stdout.split('\n'))[0].split('= ', 1)[1]
-        return long(reg_val)
+        return self.getSession(sw, thrift_port).readRegister(register, idx)
+
+    def snapshot(self, registers=None, counters=None, meters=None, switches=None):
+        """Read whole register, counter and meter arrays from the switches (all
+        of them by default) in parallel. Each of registers, counters and meters
+        is a list of names, or None for every array of that kind in a switch's
+        program. Returns switch -> column -> array, with the columns
+        register/<name>, counter/<name>/packets, counter/<name>/bytes,
+        meter/<name>/rate and meter/<name>/burst. Meter columns have a row for
+        each cell and a column for each of its rates; rates that haven't been
+        set are 0. The arrays are NumPy arrays if NumPy is installed."""
+        result = {}
+        def read(sw_name):
+            session = self.getSession(sw_name)
+            program = session.program()
+            columns = OrderedDict()
+            for name in arrayNames(program, 'register_arrays', registers):
+                columns['register/%s' % name] = toColumn(session.readRegisters(name), 'int64')
+            for name in arrayNames(program, 'counter_arrays', counters):
+                size = findArray(program, 'counter_arrays', name)['size']
+                packets, bytes = session.readCounters(name, size)
+                columns['counter/%s/packets' % name] = toColumn(packets, 'int64')
+                columns['counter/%s/bytes' % name] = toColumn(bytes, 'int64')
+            for name in arrayNames(program, 'meter_arrays', meters):
+                array = findArray(program, 'meter_arrays', name)
+                rate_count = array.get('rate_count', 2)
+                cells = [rates + [(0.0, 0)] * (rate_count - len(rates))
+                         for rates in session.readMeters(name, array['size'])]
+                columns['meter/%s/rate' % name] = toColumn([[r for r, _ in c] for c in cells], 'float64')
+                columns['meter/%s/burst' % name] = toColumn([[b for _, b in c] for c in cells], 'int64')
+            result[sw_name] = columns
+        self.forEach(switches or self.switches, read, 'taking a snapshot of')
+        return result
 
     def configureHosts(self):
-        for host_name in self.topo._host_links:
-            h = self.net.get(host_name)
-            for link in self.topo._host_links[host_name].values():
-                sw = link['sw']
-                iface = h.intfNames()[link['idx']]
-                h.cmd('ifconfig %s %s hw ether %s' % (iface, link['host_ip'], link['host_mac']))
-                h.cmd('arp -i %s -s %s %s' % (iface, link['sw_ip'], link['sw_mac']))
-                h.cmd('ethtool --offload %s rx off tx off' % iface)
-                h.cmd('ip route add %s dev %s' % (link['sw_ip'], iface))
-            h.setDefaultRoute("via %s" % link['sw_ip'])
-
-            for h2 in self.net.hosts:
-                if h == h2: continue
-                path = self.shortestpath.get(h.name, h2.name, exclude=lambda n: n in self.topo._host_links)
-                if not path: continue
-                h_link = self.topo._host_links[h.name][path[1]]
-                h2_link = self.topo._host_links[h2.name][path[-2]]
-                h.cmd('ip route add %s via %s' % (h2_link['host_ip'], h_link['sw_ip']))
+        self.forEach(self.topo._host_links.keys(), self.configureHost, 'configuring host')
+
+    def configureHost(self, host_name):
+        # Build the host's addresses, neighbors and routes as one `ip -batch`
+        # file, and apply it (and the offload settings) with a single command.
+        h = self.net.get(host_name)
+        batch, shell = [], []
+        for link in self.topo._host_links[host_name].values():
+            iface = h.intfNames()[link['idx']]
+            # Like `ifconfig <iface> <ip>`, use the address's classful netmask.
+            prefix_len = classfulPrefixLen(link['host_ip'])
+            batch += ['link set dev %s address %s' % (iface, link['host_mac']),
+                      'addr flush dev %s' % iface,
+                      'addr add %s/%d broadcast + dev %s' % (link['host_ip'], prefix_len, iface),
+                      'neigh replace %s lladdr %s dev %s nud permanent' % (link['sw_ip'], link['sw_mac'], iface),
+                      'route replace %s dev %s' % (link['sw_ip'], iface)]
+            shell.append('ethtool --offload %s rx off tx off' % iface)
+        batch.append('route replace default via %s' % link['sw_ip'])
+
+        routes = {}
+        for h2 in self.net.hosts:
+            if h == h2: continue
+            path = self.shortestpath.get(h.name, h2.name, exclude=self.isHost)
+            if not path: continue
+            h_link = self.topo._host_links[h.name][path[1]]
+            h2_link = self.topo._host_links[h2.name][path[-2]]
+            routes[h2_link['host_ip']] = h_link['sw_ip']
+        batch += ['route replace %s via %s' % route for route in aggregateRoutes(routes)]
+
+        fd, batch_file = tempfile.mkstemp(prefix='p4app_%s_' % host_name, suffix='.ip')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(batch) + '\n')
+            # The last line of the output is the exit status of the commands.
+            output = h.cmd(' && '.join(['ip -force -batch %s' % batch_file] + shell) + '; echo $?')
+        finally:
+            os.remove(batch_file)
+        lines = output.strip().splitlines()
+        if not lines or lines[-1].strip() != '0':
+            raise Exception('Could not configure %s:\n%s' % (host_name, output.strip()))
 
     def start(self):
         self.generateCommands()
         self.sendGeneratedCommands()
         self.setupMcastGroups()
         self.configureHosts()
+        self.watchLinks()
+        if self.conf.get('poll'):
+            self.startPolling(**dict((str(k), v) for k, v in self.conf['poll'].iteritems()))
+
+    def startPolling(self, interval=1.0, registers=None, counters=None, ports=True, buffer=1024):
+        # Sample the given registers and counters (all of them, if None) and
+        # the switches' port statistics every `interval` seconds, until stop().
+        self.poller = AppPoller(self.net.switches, os.environ.get('P4APP_LOGDIR', '.'),
+                                interval=interval, registers=registers, counters=counters,
+                                ports=ports, buffer=buffer, cli_path=self.cli_path,
+                                workers=self.workers)
+        self.poller.start()
+        return self.poller
+
+    def watchLinks(self):
+        # Reroute around links that are brought down with configLinkStatus
+        # (e.g. `link s1 s2 down` in the Mininet CLI), and back when they
+        # come up again.
+        configLinkStatus = self.net.configLinkStatus
+        def linkStatusHook(src, dst, status):
+            configLinkStatus(src, dst, status)
+            if status in ['up', 'down']:
+                self.linkStatusChanged(src, dst, status == 'up')
+        self.net.configLinkStatus = linkStatusHook
+
+    def linkStatusChanged(self, a, b, up):
+        start = monotonic()
+        if up: dests = self.shortestpath.addEdge(a, b)
+        else:  dests = self.shortestpath.removeEdge(a, b)
+
+        hosts = sorted(d for d in dests if d in self.host_commands)
+        changed = set()
+        for h_name in hosts:
+            old = (self.host_commands[h_name], self.host_routes[h_name])
+            self.generateHostCommands(h_name)
+            new = (self.host_commands[h_name], self.host_routes[h_name])
+            changed.update(sw for sw in self.switches
+                           if old[0][sw] != new[0][sw] or old[1][sw] != new[1][sw])
+        self.forEach(sorted(changed), self.syncSwitch, 'updating routes on')
+        if self.conf.get('auto_mcast_groups'):
+            try:
+                self.setupMcastGroups() # the trees may have to go around the link
+            except Exception as e:
+                print 'Could not update the multicast groups: %s' % e
+
+        end = monotonic()
+        event = dict(link=[a, b], status='up' if up else 'down', start=start, end=end,
+                     seconds=end - start, hosts=hosts, switches=sorted(changed))
+        self.link_events.append(event)
+        print 'Link %s-%s %s: rerouted %d hosts on %d switches in %.1fms' % (
+                a, b, event['status'], len(hosts), len(changed), event['seconds'] * 1000)
 
     def generateCommands(self):
         self.loadCommands()
         self.generateDefaultCommands()
 
     def sendGeneratedCommands(self):
-        for sw_name in self.commands:
+        def send(sw_name):
+            start = monotonic()
+            self.syncSwitch(sw_name)
+            self.loadEntryFiles(sw_name)
+            self.load_times[sw_name] = (start, monotonic())
+        self.forEach(self.commands.keys(), send, 'loading table entries into')
+
+    def switchCommands(self, sw_name):
+        commands = list(self.commands[sw_name])
+        for h_name in sorted(self.host_commands):
+            commands += self.host_commands[h_name][sw_name]
+        return commands
+
+    def switchRoutes(self, sw_name):
+        routes = {}
+        for h_name in sorted(self.host_routes):
+            for prefix, members in self.host_routes[h_name][sw_name].iteritems():
+                routes.setdefault(prefix, []).extend(members)
+        return routes
+
+    def syncSwitch(self, sw_name):
+        self.syncTables(sw_name, TableState.fromCommands(self.switchCommands(sw_name)))
+        if self.ecmp: self.syncRoutes(sw_name)
+
+    def syncTables(self, sw_name, desired):
+        # Send only what differs between the desired and the installed state.
+        for warning in desired.warnings:
+            print '%s: %s' % (sw_name, warning)
+        installed = self.installed.setdefault(sw_name, InstalledTables())
+        ops = installed.plan(desired)
+        if not ops: return
+        commands = [installed.command(op) for op in ops]
+        results = self.sendCommands(commands, sw=self.net.get(sw_name))
+        for op, result in zip(ops, results):
+            installed.apply(op, result)
+
+    def syncRoutes(self, sw_name):
+        sw = self.net.get(sw_name)
+        def send(commands):
+            if not commands: return []
+            return self.sendCommands(commands, sw=sw)
+        for error in self.selectors[sw_name].sync(('_drop', ()), self.switchRoutes(sw_name), send):
+            print '%s: %s' % (sw_name, error)
+
+    def reconfigure(self):
+        # Regenerate every switch's configuration from scratch and send the
+        # differences.
+        self.command_files = dict((sw, []) for sw in self.switches)
+        self.commands = dict((sw, []) for sw in self.switches)
+        self.entry_files = dict((sw, []) for sw in self.switches)
+        self.generateCommands()
+        self.sendGeneratedCommands()
+        self.setupMcastGroups()
+
+    def hotSwap(self, json_path):
+        # Load the new program into every switch, then replay the table entries:
+        # they don't survive the swap. Multicast groups live in the switch's
+        # replication engine, not in the P4 program, so they do.
+        def swap(sw_name):
             sw = self.net.get(sw_name)
-            self.sendCommands(self.commands[sw_name], sw=sw)
+            self.sendCommands(['load_new_config_file %s' % json_path, 'swap_configs'], sw=sw)
+            sw.json_path = json_path
+            self.getSession(sw).json_path = json_path
+        self.forEach(self.switches, swap, 'swapping the program on')
+        self.installed = dict((sw, InstalledTables()) for sw in self.switches)
+        self.selectors = dict((sw, InstalledSelector('ipv4_lpm')) for sw in self.switches)
+        self.loaded_entry_files = dict((sw, set()) for sw in self.switches)
+        self.sendGeneratedCommands()
 
     def loadCommands(self):
         for sw in self.switches:
@@ -143,9 +440,14 @@ class AppController:
                 for x in extra_commands:
                     if x.endswith('.txt'):
                         self.command_files[sw].append(x)
+                    elif x.endswith(ENTRY_FILE_EXTENSION):
+                        self.entry_files[sw].append(x)
                     else:
                         self.commands[sw].append(x)
 
+            elif extra_commands.endswith(ENTRY_FILE_EXTENSION):
+                self.entry_files[sw].append(extra_commands)
+
             else: # path to file that contains commands
                 self.command_files[sw].append(extra_commands)
 
@@ -153,14 +455,78 @@ class AppController:
             for filename in self.command_files[sw]:
                 self.commands[sw] += self.readCommands(filename)
 
+    def loadEntryFiles(self, sw_name):
+        # Entry files go straight into the switch: they aren't merged or
+        # diffed with the other commands, and each is loaded only once.
+        session = self.getSession(sw_name)
+        for path in self.entry_files[sw_name]:
+            if path in self.loaded_entry_files[sw_name]: continue
+            entries = EntryFile(path)
+            entries.validate(session.program())
+            start = monotonic()
+            if entries.other:
+                self.sendCommands(entries.other, sw=sw_name)
+            if session.inProcess() and BmMatchParam is not None:
+                errors = session.addEntries(entries.thriftCalls())
+            else:
+                errors, batch = [], []
+                for command in entries.commands():
+                    batch.append(command)
+                    if len(batch) == ENTRY_FILE_BATCH:
+                        errors += self.entryErrors(session.run(batch))
+                        batch = []
+                if batch: errors += self.entryErrors(session.run(batch))
+            seconds = monotonic() - start
+            print '%s: loaded %d entries from %s in %.2fs (%.0f entries/s)' % (
+                    sw_name, entries.count() - len(errors), path, seconds,
+                    entries.count() / max(seconds, 1e-9))
+            if errors:
+                for error in errors[:10]:
+                    print '%s: %s' % (sw_name, error)
+                raise Exception('%d entries from %s could not be added' % (len(errors), path))
+            self.loaded_entry_files[sw_name].add(path)
+
+    def entryErrors(self, results):
+        return [r.get('error', r['raw'].strip()) for r in results
+                if 'error' in r or 'handle' not in r]
+
     def setupMcastGroups(self):
         self.loadMcastGroups()
 
-        for sw in self.switches:
-            for mgid, ports in self.mcast_groups[sw].iteritems():
-                self.createMcastGroup(mgid, ports, sw=self.net.get(sw))
+        self.forEach(self.switches, self.syncMcastGroups, 'creating multicast groups on')
+
+    def syncMcastGroups(self, sw_name):
+        sw = self.net.get(sw_name)
+        desired = self.mcast_groups[sw_name]
+        installed = self.installed_mcast[sw_name]
+        create, update, destroy = planMcastGroups(desired, installed)
+        commands, ops = [], [] # ops: (kind, mgid, number of commands)
+        for mgid in destroy:
+            commands += ['mc_mgrp_destroy %d' % mgid, 'mc_node_destroy %d' % installed[mgid][0]]
+            ops.append(('destroy', mgid, 2))
+        for mgid in update:
+            commands.append('mc_node_update %d %s' % (installed[mgid][0], ' '.join(map(str, desired[mgid]))))
+            ops.append(('update', mgid, 1))
+        results, handles, errors = self.sendMcastCommands(dict((mgid, desired[mgid]) for mgid in create),
+                                                          sw=sw, before=commands)
+
+        # Only record what the switch did, so that the rest is tried again
+        # the next time.
+        results = iter(results)
+        for kind, mgid, n in ops:
+            error = firstError([next(results, None) for _ in range(n)])
+            if error:
+                errors.append('Could not %s multicast group %d: %s' % (kind, mgid, error))
+            elif kind == 'destroy':
+                del installed[mgid]
+            else:
+                installed[mgid] = (installed[mgid][0], desired[mgid])
+        for mgid, handle in handles.iteritems():
+            installed[mgid] = (handle, desired[mgid])
+        if errors: raise Exception('; '.join(errors))
 
     def loadMcastGroups(self):
+        self.mcast_groups_files = dict((sw, []) for sw in self.switches)
         for sw in self.switches:
             if 'switches' not in self.conf or sw not in self.conf['switches'] or 'mcast_groups' not in self.conf['switches'][sw]:
                 continue
@@ -175,40 +541,91 @@ class AppController:
 
             self.mcast_groups_files[sw] += mcast_groups_files
 
+        # Groups from files take precedence over automatic ones with the same mgid.
+        self.mcast_groups = self.autoMcastGroups()
         for sw in self.switches:
             for filename in self.mcast_groups_files[sw]:
                 self.mcast_groups[sw].update(self.readMcastGroups(filename, sw))
 
-
-
+    def autoMcastGroups(self):
+        # `auto_mcast_groups` maps mgids to "all" or a list of hosts. Each group
+        # follows a spanning tree of the switches, so that a packet sent to it
+        # reaches every member exactly once, provided the P4 program drops the
+        # copy that would go back out of the port it came in on.
+        groups = dict((sw, {}) for sw in self.switches)
+        auto = self.conf.get('auto_mcast_groups', {})
+        if not auto: return groups
+        parent = spanningTree(self.shortestpath, self.switches, self.isHost)
+        for mgid, hosts in sorted(auto.iteritems()):
+            if hosts == 'all': hosts = sorted(self.topo._host_links)
+            host_ports = {} # sw -> ports of member hosts
+            for h in hosts:
+                assert h in self.topo._host_links, "Could not find host %s for multicast group %s" % (h, mgid)
+                sw = sorted(self.topo._host_links[h])[0] # one copy, even for multi-homed hosts
+                host_ports.setdefault(sw, []).append(self.getPortForHost(sw, h))
+            ports = dict((sw, list(p)) for sw, p in host_ports.iteritems())
+            for a, b in pruneTree(parent, host_ports):
+                ports.setdefault(a, []).append(self.topo._port_map[a][b])
+                ports.setdefault(b, []).append(self.topo._port_map[b][a])
+            for sw, p in ports.iteritems():
+                groups[sw][int(mgid)] = sorted(p)
+        return groups
 
     def generateDefaultCommands(self):
         for sw in self.topo.switches():
             if sw not in self.commands: self.commands[sw] = []
             self.commands[sw] += [
                 'table_set_default send_frame _drop',
-                'table_set_default forward _drop',
-                'table_set_default ipv4_lpm _drop']
-
-        for host_name in self.topo._host_links:
-            h = self.net.get(host_name)
-            for link in self.topo._host_links[host_name].values():
-                sw = link['sw']
-                self.commands[sw].append('table_add send_frame rewrite_mac %d => %s' % (link['sw_port'], link['sw_mac']))
-                self.commands[sw].append('table_add forward set_dmac %s => %s' % (link['host_ip'], link['host_mac']))
-                self.commands[sw].append('table_add ipv4_lpm set_nhop %s/32 => %s %d' % (link['host_ip'], link['host_ip'], link['sw_port']))
-
+                'table_set_default forward _drop']
+            if not self.ecmp: # otherwise, syncRoutes() sets it
+                self.commands[sw].append('table_set_default ipv4_lpm _drop')
 
         for h in self.net.hosts:
-            h_link = self.topo._host_links[h.name].values()[0]
-            for sw in self.net.switches:
-                path = self.shortestpath.get(sw.name, h.name, exclude=lambda n: n in self.topo._host_links)
-                if not path: continue
-                if not path[1] in self.topo._port_map: continue # next hop is a switch
-                sw_link = self.topo._sw_links[sw.name][path[1]]
-                self.commands[sw.name].append('table_add send_frame rewrite_mac %d => %s' % (sw_link[0]['port'], sw_link[0]['mac']))
-                self.commands[sw.name].append('table_add forward set_dmac %s => %s' % (h_link['host_ip'], sw_link[1]['mac']))
-                self.commands[sw.name].append('table_add ipv4_lpm set_nhop %s/32 => %s %d' % (h_link['host_ip'], h_link['host_ip'], sw_link[0]['port']))
+            self.generateHostCommands(h.name)
+
+    def generateHostCommands(self, h_name):
+        # The entries that get packets for h_name to it.
+        commands = self.host_commands[h_name] = dict((sw, []) for sw in self.switches)
+        self.host_routes[h_name] = dict((sw, {}) for sw in self.switches)
+
+        for link in self.topo._host_links[h_name].values():
+            sw = link['sw']
+            commands[sw].append('table_add send_frame rewrite_mac %d => %s' % (link['sw_port'], link['sw_mac']))
+            commands[sw].append('table_add forward set_dmac %s => %s' % (link['host_ip'], link['host_mac']))
+            self.addRoute(h_name, sw, link['host_ip'] + '/32', link['host_ip'], link['sw_port'])
+
+        h_link = self.topo._host_links[h_name].values()[0]
+        for sw in self.net.switches:
+            if self.ecmp:
+                self.generateEcmpCommands(sw.name, h_name, h_link)
+                continue
+            path = self.shortestpath.get(sw.name, h_name, exclude=self.isHost)
+            if not path: continue
+            if not path[1] in self.topo._port_map: continue # next hop is a switch
+            sw_link = self.topo._sw_links[sw.name][path[1]]
+            commands[sw.name].append('table_add send_frame rewrite_mac %d => %s' % (sw_link[0]['port'], sw_link[0]['mac']))
+            commands[sw.name].append('table_add forward set_dmac %s => %s' % (h_link['host_ip'], sw_link[1]['mac']))
+            self.addRoute(h_name, sw.name, h_link['host_ip'] + '/32', h_link['host_ip'], sw_link[0]['port'])
+
+    def generateEcmpCommands(self, sw_name, h_name, h_link):
+        # Route to the host over every next hop on a shortest path. Each next
+        # hop gets its own nhop_ipv4 value, so that `forward` can give it its
+        # own destination MAC.
+        commands = self.host_commands[h_name][sw_name]
+        for hop in self.shortestpath.nextHops(sw_name, h_name, exclude=self.isHost):
+            if hop not in self.topo._port_map: continue # directly attached host
+            sw_link = self.topo._sw_links[sw_name][hop]
+            port = sw_link[0]['port']
+            commands.append('table_add send_frame rewrite_mac %d => %s' % (port, sw_link[0]['mac']))
+            commands.append('table_add forward set_dmac %s => %s' % (linkNhop(port), sw_link[1]['mac']))
+            self.addRoute(h_name, sw_name, h_link['host_ip'] + '/32', linkNhop(port), port)
+
+    def addRoute(self, h_name, sw_name, prefix, nhop, port):
+        if self.ecmp:
+            routes = self.host_routes[h_name][sw_name]
+            routes.setdefault(prefix, []).append(('set_nhop', (nhop, str(port))))
+        else:
+            self.host_commands[h_name][sw_name].append('table_add ipv4_lpm set_nhop %s => %s %d' % (prefix, nhop, port))
 
     def getPortForHost(self, sw, h=None, ip=None):
         if ip is not None:
@@ -230,4 +647,15 @@ class AppController:
 
 
     def stop(self):
-        pass
+        if self.poller is not None:
+            self.poller.stop()
+            print 'Took %d samples (%d skipped, %d failed) of %d values from the switches' % (
+                    self.poller.taken, self.poller.overruns, self.poller.errors, self.poller.width)
+            self.poller = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
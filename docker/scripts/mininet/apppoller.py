@@ -0,0 +1,169 @@
+import json
+import os
+import struct
+import threading
+import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from apptimings import monotonic
+from switchsession import SwitchSession, arrayNames, findArray
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TIMESERIES_FILENAME = 'timeseries.bin'
+TIMESERIES_HEADER_FILENAME = 'timeseries.json'
+
+PORT_STATS = ['rx_packets', 'rx_bytes', 'rx_dropped', 'tx_packets', 'tx_bytes', 'tx_dropped']
+
+def readPortStats(intf):
+    values = []
+    for stat in PORT_STATS:
+        try:
+            with open('/sys/class/net/%s/statistics/%s' % (intf, stat), 'r') as f:
+                values.append(long(f.read()))
+        except (IOError, ValueError):
+            values.append(-1) # the interface went away
+    return values
+
+class SwitchSampler:
+    """Reads one switch's share of a sample. The columns are fixed when it's
+    created, so that every sample has the same layout."""
+
+    def __init__(self, sw, cli_path, registers=None, counters=None, ports=True):
+        self.name = sw.name
+        self.session = SwitchSession(sw.thrift_port, cli_path=cli_path,
+                                     json_path=getattr(sw, 'json_path', None))
+        program = self.session.program()
+        self.registers = [(name, findArray(program, 'register_arrays', name)['size'])
+                          for name in arrayNames(program, 'register_arrays', registers)]
+        self.counters = [(name, findArray(program, 'counter_arrays', name)['size'])
+                         for name in arrayNames(program, 'counter_arrays', counters)]
+        self.intfs = [i for i in sw.intfNames() if i != 'lo'] if ports else []
+
+    def columns(self):
+        columns = []
+        for name, size in self.registers:
+            columns.append(('%s/register/%s' % (self.name, name), size))
+        for name, size in self.counters:
+            columns.append(('%s/counter/%s/packets' % (self.name, name), size))
+            columns.append(('%s/counter/%s/bytes' % (self.name, name), size))
+        for intf in self.intfs:
+            for stat in PORT_STATS:
+                columns.append(('%s/port/%s/%s' % (self.name, intf, stat), 1))
+        return columns
+
+    def sample(self):
+        values = []
+        for name, _ in self.registers:
+            values += self.session.readRegisters(name)
+        for name, size in self.counters:
+            packets, bytes = self.session.readCounters(name, size)
+            values += packets + bytes
+        for intf in self.intfs:
+            values += readPortStats(intf)
+        return values
+
+    def close(self):
+        self.session.close()
+
+class AppPoller(threading.Thread):
+    """Samples registers, counters and port statistics from every switch at a
+    fixed interval, on its own control-plane sessions. Each sample is appended
+    to timeseries.bin in the log dir as one fixed-size record: the time
+    (CLOCK_MONOTONIC, as a double) followed by every value as a signed 64-bit
+    integer, little-endian. timeseries.json describes the columns. The last
+    `buffer` samples are also kept in memory, in self.samples."""
+
+    def __init__(self, switches, log_dir, interval=1.0, registers=None, counters=None,
+                 ports=True, buffer=1024, cli_path='simple_switch_CLI', workers=8):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = float(interval)
+        self.samplers = [SwitchSampler(sw, cli_path, registers, counters, ports) for sw in switches]
+        self.columns = [c for s in self.samplers for c in s.columns()]
+        self.width = sum(count for _, count in self.columns)
+        self.record = struct.Struct('<d%dq' % self.width)
+        self.samples = deque(maxlen=buffer) # (time, values)
+        self.taken = 0
+        self.overruns = 0
+        self.errors = 0
+        self.pool = ThreadPool(max(1, min(workers, len(self.samplers))))
+        self.stopped = threading.Event()
+        self.path = os.path.join(log_dir, TIMESERIES_FILENAME)
+        self.writeHeader(os.path.join(log_dir, TIMESERIES_HEADER_FILENAME))
+
+    def writeHeader(self, path):
+        columns, offset = [], 0
+        for name, count in self.columns:
+            columns.append(dict(name=name, offset=offset, count=count))
+            offset += count
+        header = dict(data=TIMESERIES_FILENAME, interval=self.interval,
+                      record_format=self.record.format, record_size=self.record.size,
+                      columns=columns)
+        with open(path, 'w') as f:
+            json.dump(header, f, indent=2)
+
+    def sample(self):
+        t = monotonic()
+        values = []
+        for v in self.pool.map(lambda s: s.sample(), self.samplers):
+            values += v
+        return t, values
+
+    def run(self):
+        with open(self.path, 'wb') as f:
+            next_time = monotonic()
+            while not self.stopped.is_set():
+                try:
+                    t, values = self.sample()
+                    self.samples.append((t, values))
+                    f.write(self.record.pack(t, *values))
+                    f.flush()
+                    self.taken += 1
+                except Exception:
+                    self.errors += 1
+                    if self.errors == 1: traceback.print_exc()
+                # Keep to the schedule; if a sample took longer than the
+                # interval, skip the samples it overran.
+                next_time += self.interval
+                now = monotonic()
+                if next_time < now:
+                    missed = int((now - next_time) / self.interval) + 1
+                    self.overruns += missed
+                    next_time += missed * self.interval
+                self.stopped.wait(next_time - now)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive(): self.join()
+        self.pool.close()
+        self.pool.join()
+        for sampler in self.samplers:
+            sampler.close()
+
+def loadTimeSeries(log_dir):
+    """Read the samples a poller wrote to log_dir. Returns the times and a map
+    from column name to values, one row per sample; with NumPy, as arrays."""
+    with open(os.path.join(log_dir, TIMESERIES_HEADER_FILENAME), 'r') as f:
+        header = json.load(f)
+    path = os.path.join(log_dir, header['data'])
+    record = struct.Struct(str(header['record_format']))
+    if numpy is not None:
+        dtype = numpy.dtype([('time', '<f8'), ('values', '<i8', (record.size - 8) / 8)])
+        data = numpy.fromfile(path, dtype=dtype)
+        times, values = data['time'], data['values'].reshape(len(data), -1)
+    else:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        n = len(raw) / record.size # a partly written last record is dropped
+        rows = [record.unpack_from(raw, i * record.size) for i in range(n)]
+        times, values = [r[0] for r in rows], [r[1:] for r in rows]
+    columns = {}
+    for c in header['columns']:
+        lo, hi = c['offset'], c['offset'] + c['count']
+        columns[c['name']] = values[:, lo:hi] if numpy is not None else [v[lo:hi] for v in values]
+    return times, columns
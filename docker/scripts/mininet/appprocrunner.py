@@ -1,8 +1,13 @@
-import subprocess
 import re
+import signal
 from time import sleep
 import os
 
+from apptimings import monotonic
+
+# How long background commands get to exit after SIGINT before they're killed.
+KILL_TIMEOUT = 2
+
 class AppProcess:
 
     def __init__(self, runner, host, host_conf):
@@ -28,7 +33,10 @@ class AppProcess:
     def start(self):
         self.stdout_file = open(self.stdout_filename, 'w')
         self.cmd = self.formatCmd(self.host_conf['cmd'])
-        self.proc = self.host.popen(self.cmd, stdout=self.stdout_file, shell=True, preexec_fn=os.setpgrp)
+        # With a placement, the command starts out pinned and in its cgroup.
+        placement = self.runner.resources.placement(self.host.name) if self.runner.resources else None
+        cmd = placement.command(self.cmd) if placement else self.cmd
+        self.proc = self.host.popen(cmd, stdout=self.stdout_file, shell=True, preexec_fn=os.setpgrp)
 
         print self.host.name, self.cmd
 
@@ -50,55 +58,43 @@ class AppProcess:
 
         return self.proc.returncode
 
-    def run_command(self, command):
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-        p.wait()
-        stdout, stderr = p.communicate()
-        return (p.returncode, stdout, stderr)
-
-    def killTree(self):
-        _, stdout, _ = self.run_command('pstree -p %d' % self.proc.pid)
-        descendants = re.findall("\(([^)]*)\)", stdout)
-
-        cmd = 'kill -INT %s' % ' '.join(descendants)
-        rc, stdout, _ = self.run_command(cmd)
-
-        print "Sent INT to children of PID %d: `%s`. Return code: %d" % (self.proc.pid, cmd, rc)
+    def signal(self, sig):
+        # The command was started in a process group of its own, so this
+        # reaches everything it started too.
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            pass # the group is gone
+
+    def isRunning(self):
+        self.proc.poll() # reap the command itself, if it has exited
+        try:
+            os.killpg(self.proc.pid, 0)
+        except OSError:
+            return False
+        return True
 
     def kill(self):
-        if self.proc.returncode is not None: # already exited
-            return
-
-        self.run_command('pkill -INT -P %d' % self.proc.pid)
-        sleep(0.2)
-
-        rc, _, _ = self.run_command('pkill -0 -P %d' % self.proc.pid) # check if it's still running
-        if rc != 0: # the process group is not running
-            return
-
-        sleep(0.5) # give it a little more time to exit gracefully
-
-        rc, _, _ = self.run_command('pkill -0 -P %d' % self.proc.pid) # check if it's still running
-        if rc != 0: # the process group is not running
-            return
-
-        self.killTree()
+        if self.isRunning():
+            self.signal(signal.SIGINT)
 
 
 class AppProcRunner:
 
-    def __init__(self, manifest=None, target=None, topo=None, net=None, log_dir=None):
+    def __init__(self, manifest=None, target=None, topo=None, net=None, log_dir=None, resources=None):
         self.manifest = manifest
         self.target = target
         self.conf = manifest['targets'][target]
         self.topo = topo
         self.net = net
         self.log_dir = log_dir
+        self.resources = resources
         self.AppProcessClass = AppProcess
 
         self.app_procs = []
         self.foreground_procs, self.background_procs = [], []
         self.return_codes = []
+        self.kill_start = self.kill_end = None
 
     def setupProcs(self):
         os.environ.update(dict(map(lambda (k,v): (k, str(v)), self.conf['parameters'].iteritems())))
@@ -126,10 +122,27 @@ class AppProcRunner:
             self.return_codes.append(rc)
 
     def killBackgroundProcs(self):
+        # Interrupt every background command at once, wait for them together,
+        # and kill whatever is still running at the deadline.
+        self.kill_start = monotonic()
         for p in self.background_procs:
             p.kill()
+        deadline = self.kill_start + self.conf.get('kill_timeout', KILL_TIMEOUT)
+        pending = list(self.background_procs)
+        delay = 0.005
+        while True:
+            pending = [p for p in pending if p.isRunning()]
+            if not pending or monotonic() > deadline: break
+            sleep(delay)
+            delay = min(delay * 2, 0.1)
+        for p in pending:
+            print "%s: `%s` did not exit after SIGINT; sending SIGKILL" % (p.host.name, p.cmd)
+            p.signal(signal.SIGKILL)
+
+        for p in self.background_procs:
             rc = p.waitForExit()
             self.return_codes.append(rc)
+        self.kill_end = monotonic()
 
     def runAfterCmds(self):
         if 'after' in self.conf and 'cmd' in self.conf['after']:
@@ -137,11 +150,14 @@ class AppProcRunner:
             for cmd in cmds:
                 os.system(cmd)
 
-    def runall(self):
+    def runall(self, hold=None):
         self.setupProcs()
 
         self.startAllProcs()
 
+        # Keep the processes running until `hold` returns (e.g. in watch mode)
+        if hold: hold()
+
         self.waitForForegroundProcs()
 
         self.killBackgroundProcs()
@@ -0,0 +1,251 @@
+import json
+import os
+import pipes
+import re
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+RESOURCES_FILENAME = 'resources.json'
+
+# Period for CPU limits, in microseconds.
+CPU_PERIOD = 100000
+
+def parseCpuList(cpus):
+    "A list of CPU numbers from e.g. '0-3,8', [0, 1] or 2."
+    if isinstance(cpus, (int, long)): return [cpus]
+    if not isinstance(cpus, basestring): return [int(c) for c in cpus]
+    result = []
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part: continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            result += range(int(lo), int(hi) + 1)
+        else:
+            result.append(int(part))
+    return result
+
+def formatCpuList(cpus):
+    return ','.join(str(c) for c in cpus)
+
+def availableCpus():
+    "The CPUs this process may run on."
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('Cpus_allowed_list:'):
+                return parseCpuList(line.split(':', 1)[1])
+    return range(os.sysconf('SC_NPROCESSORS_ONLN'))
+
+def parseSize(size):
+    "Bytes from e.g. 536870912, '512M' or '2G'."
+    if isinstance(size, (int, long)): return size
+    m = re.match(r'^\s*(\d+)\s*([kKmMgG]?)[bB]?\s*$', size)
+    if not m: raise Exception('Bad memory size: %s' % size)
+    return int(m.group(1)) << {'': 0, 'k': 10, 'm': 20, 'g': 30}[m.group(2).lower()]
+
+def readInt(path):
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+        return None if value == 'max' else int(value)
+    except (IOError, ValueError):
+        return None
+
+def writeValue(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+def cgroupVersion():
+    if os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')): return 2
+    if os.path.isdir(os.path.join(CGROUP_ROOT, 'memory')): return 1
+    return None
+
+class Cgroup:
+    """A cgroup for one switch or host, with optional CPU (in cores) and
+    memory limits. Works with cgroup v2, and with the cpu, cpuacct and memory
+    hierarchies of cgroup v1."""
+
+    def __init__(self, name, cpu_limit=None, memory_limit=None):
+        self.version = cgroupVersion()
+        if self.version == 2:
+            self.dirs = [os.path.join(CGROUP_ROOT, name)]
+        elif self.version == 1:
+            self.dirs = [os.path.join(CGROUP_ROOT, h, name) for h in ['cpu,cpuacct', 'memory']]
+        else:
+            raise Exception('cgroups are not mounted at %s' % CGROUP_ROOT)
+        for d in self.dirs:
+            if self.version == 2: self.enableControllers(d)
+            if not os.path.isdir(d): os.makedirs(d)
+        if cpu_limit is not None:
+            quota = int(float(cpu_limit) * CPU_PERIOD)
+            if self.version == 2:
+                self.write('cpu.max', '%d %d' % (quota, CPU_PERIOD))
+            else:
+                self.write('cpu.cfs_period_us', CPU_PERIOD)
+                self.write('cpu.cfs_quota_us', quota)
+        if memory_limit is not None:
+            self.write('memory.max' if self.version == 2 else 'memory.limit_in_bytes',
+                       parseSize(memory_limit))
+
+    def enableControllers(self, path):
+        # A v2 cgroup only has the cpu and memory files if every cgroup above
+        # it passes those controllers down.
+        parents = [CGROUP_ROOT]
+        for part in os.path.relpath(os.path.dirname(path), CGROUP_ROOT).split('/'):
+            parents.append(os.path.join(parents[-1], part))
+        for p in parents:
+            if not os.path.isdir(p): os.mkdir(p)
+            try:
+                writeValue(os.path.join(p, 'cgroup.subtree_control'), '+cpu +memory')
+            except IOError:
+                pass # e.g. the cgroup has processes of its own
+
+    def find(self, filename):
+        for d in self.dirs:
+            path = os.path.join(d, filename)
+            if os.path.exists(path): return path
+        return None
+
+    def write(self, filename, value):
+        path = self.find(filename)
+        if path is None:
+            raise Exception('%s has no %s; is its controller enabled?' % (self.dirs[0], filename))
+        writeValue(path, value)
+
+    def addPid(self, pid):
+        for d in self.dirs:
+            writeValue(os.path.join(d, 'cgroup.procs'), pid)
+
+    def usage(self):
+        "CPU time in seconds, and current and peak memory in bytes."
+        if self.version == 2:
+            cpu_s = None
+            try:
+                with open(os.path.join(self.dirs[0], 'cpu.stat'), 'r') as f:
+                    for line in f:
+                        key, value = line.split()
+                        if key == 'usage_usec': cpu_s = int(value) / 1e6
+            except IOError:
+                pass
+            memory = readInt(os.path.join(self.dirs[0], 'memory.current'))
+            peak = readInt(os.path.join(self.dirs[0], 'memory.peak'))
+        else:
+            usage_ns = readInt(os.path.join(self.dirs[0], 'cpuacct.usage'))
+            cpu_s = usage_ns / 1e9 if usage_ns is not None else None
+            memory = readInt(os.path.join(self.dirs[1], 'memory.usage_in_bytes'))
+            peak = readInt(os.path.join(self.dirs[1], 'memory.max_usage_in_bytes'))
+        return dict(cpu_s=cpu_s, memory_bytes=memory, memory_peak_bytes=peak)
+
+    def remove(self):
+        for d in self.dirs:
+            try:
+                os.rmdir(d)
+            except OSError:
+                pass # something is still running in it
+
+class Placement:
+    "Where one switch or host runs: its CPUs and its cgroup."
+
+    def __init__(self, name, kind, cpus=None, cgroup=None, cpu_limit=None, memory_limit=None):
+        self.name = name
+        self.kind = kind
+        self.cpus = cpus
+        self.cgroup = cgroup
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+
+    def cpuList(self):
+        return formatCpuList(self.cpus) if self.cpus else None
+
+    def prefix(self):
+        """The argv to run a command with, so that it starts out in the cgroup
+        and on the CPUs, and everything it starts inherits them. It's part of
+        the command itself, since the processes are started from a
+        multi-threaded process, where preexec_fn isn't safe."""
+        argv = []
+        if self.cgroup:
+            joins = ['echo $$ > %s' % pipes.quote(os.path.join(d, 'cgroup.procs'))
+                     for d in self.cgroup.dirs]
+            argv += ['sh', '-c', '; '.join(joins) + '; exec "$@"', 'sh']
+        if self.cpus:
+            argv += ['taskset', '-c', self.cpuList()]
+        return argv
+
+    def command(self, cmd):
+        "A shell command that runs the shell command `cmd` with the placement."
+        prefix = self.prefix()
+        if not prefix: return cmd
+        return ' '.join(pipes.quote(a) for a in prefix + ['sh', '-c', cmd])
+
+    def report(self):
+        report = dict(kind=self.kind, cpus=self.cpuList(), cpu_limit=self.cpu_limit,
+                      memory_limit=self.memory_limit)
+        if self.cgroup:
+            report['cgroup'] = self.cgroup.dirs[0]
+            report.update(self.cgroup.usage())
+        return report
+
+class AppResources:
+    """Places a target's switches and hosts on CPUs and in cgroups, from the
+    target's "resources" settings and each switch's and host's own ones. A
+    node with "cpus" set to a number gets that many CPUs of its own out of
+    the pool, switches first; once the pool runs out, CPUs are shared."""
+
+    def __init__(self, conf, switch_names, host_names):
+        self.conf = conf.get('resources', {})
+        self.pool = parseCpuList(self.conf['cpus']) if 'cpus' in self.conf else availableCpus()
+        self.next_cpu = 0
+        self.cgroup_base = 'p4app-%d' % os.getpid()
+        self.cgroups_error = None
+        self.placements = {}
+        for kind, names, node_conf in [('switch', switch_names, conf.get('switches', {})),
+                                       ('host', host_names, conf.get('hosts', {}))]:
+            for name in sorted(names):
+                settings = dict(self.conf.get(kind, {}))
+                own = node_conf.get(name, {})
+                settings.update((k, own[k]) for k in ['cpus', 'cpu_limit', 'memory_limit'] if k in own)
+                self.placements[name] = self.place(name, kind, settings)
+
+    def takeCpus(self, n):
+        cpus = []
+        for _ in range(n):
+            cpus.append(self.pool[self.next_cpu % len(self.pool)])
+            self.next_cpu += 1
+        return sorted(set(cpus))
+
+    def place(self, name, kind, settings):
+        cpus = settings.get('cpus')
+        if isinstance(cpus, (int, long)): cpus = self.takeCpus(cpus)
+        elif cpus is not None: cpus = parseCpuList(cpus)
+        cpu_limit, memory_limit = settings.get('cpu_limit'), settings.get('memory_limit')
+        cgroup = None
+        if self.conf.get('cgroups', True) and not self.cgroups_error:
+            try:
+                cgroup = Cgroup(os.path.join(self.cgroup_base, name), cpu_limit, memory_limit)
+            except Exception as e:
+                self.cgroups_error = str(e)
+                print 'Not using cgroups: %s' % e
+        return Placement(name, kind, cpus, cgroup, cpu_limit, memory_limit)
+
+    def placement(self, name):
+        return self.placements.get(name)
+
+    def prefix(self, name):
+        return self.placements[name].prefix() if name in self.placements else []
+
+    def save(self, log_dir):
+        "Write each node's placement and cgroup usage to resources.json."
+        report = dict(cgroups_error=self.cgroups_error,
+                      nodes=dict((name, p.report()) for name, p in self.placements.items()))
+        path = os.path.join(log_dir, RESOURCES_FILENAME)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return path
+
+    def close(self):
+        for p in self.placements.values():
+            if p.cgroup: p.cgroup.remove()
+        for hierarchy in ([''] if cgroupVersion() == 2 else ['cpu,cpuacct', 'memory']):
+            try:
+                os.rmdir(os.path.join(CGROUP_ROOT, hierarchy, self.cgroup_base))
+            except OSError:
+                pass
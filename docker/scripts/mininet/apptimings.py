@@ -0,0 +1,86 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import time
+from contextlib import contextmanager
+
+TIMINGS_FILENAME = 'timings.json'
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def findClockGettime():
+    for name in [ctypes.util.find_library('rt'), ctypes.util.find_library('c')]:
+        if name is None: continue
+        try:
+            return ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+    return None
+
+_clock_gettime = findClockGettime()
+
+def monotonic():
+    # CLOCK_MONOTONIC is shared by every process on the machine, so times
+    # recorded by the runner and by the backends it starts can be compared.
+    if hasattr(time, 'monotonic'): return time.monotonic()
+    if _clock_gettime is None: return time.time()
+    t = timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        return time.time()
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+def span(start, end):
+    return dict(start=start, end=end, seconds=end - start)
+
+class AppTimings:
+    """Collects phase timings for a run and merges them into timings.json in
+    the log dir. Several processes may contribute to the same run, one after
+    the other; each save() adds to what is already in the file."""
+
+    def __init__(self, log_dir):
+        self.path = os.path.join(log_dir, TIMINGS_FILENAME)
+        self.phases = []
+        self.switches = {}
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @contextmanager
+    def phase(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, monotonic())
+
+    def record(self, name, start, end):
+        entry = span(start, end)
+        entry['name'] = name
+        self.phases.append(entry)
+
+    def recordSwitch(self, sw_name, what, start, end):
+        self.switches.setdefault(sw_name, {})[what] = span(start, end)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict(clock='monotonic', phases=[], switches={})
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self):
+        timings = self.load()
+        timings['phases'] += self.phases
+        for sw_name, entries in self.switches.iteritems():
+            timings['switches'].setdefault(sw_name, {}).update(entries)
+        timings['phases'].sort(key=lambda p: p['start'])
+
+        with open(self.path, 'w') as f:
+            json.dump(timings, f, indent=2, sort_keys=True)
+
+        self.phases = []
+        self.switches = {}
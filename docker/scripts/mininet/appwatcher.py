@@ -0,0 +1,147 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import traceback
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_ISDIR       = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+def loadInotify():
+    name = ctypes.util.find_library('c')
+    if name is None: return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init'): return None
+    return libc
+
+class FileWatcher:
+    """Waits for changes to the files under a directory. Uses inotify when it's
+    available, and falls back to polling modification times (e.g. for bind
+    mounts from hosts that don't forward inotify events)."""
+
+    def __init__(self, path, settle=0.2, poll_interval=1.0):
+        self.path = path
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.libc = loadInotify()
+        if self.libc is not None:
+            fd = self.libc.inotify_init()
+            if fd >= 0:
+                self.fd = fd
+                for d, _, _ in os.walk(path):
+                    self.addWatch(d)
+        self.snapshot = None if self.fd is not None else self.takeSnapshot()
+
+    def addWatch(self, path):
+        self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+
+    def takeSnapshot(self):
+        snapshot = {}
+        for d, _, files in os.walk(self.path):
+            for name in files:
+                p = os.path.join(d, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                snapshot[p] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def readEvents(self):
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Watch new subdirectories too. We don't know the path of the
+                # directory that contains it from the event alone, so rescan.
+                for d, _, _ in os.walk(self.path):
+                    self.addWatch(d)
+
+    def wait(self, timeout=None):
+        "Block until something changes. Returns False on timeout."
+        deadline = None if timeout is None else time.time() + timeout
+        if self.fd is None:
+            while True:
+                time.sleep(self.poll_interval)
+                snapshot = self.takeSnapshot()
+                if snapshot != self.snapshot:
+                    self.snapshot = snapshot
+                    return True
+                if deadline is not None and time.time() > deadline:
+                    return False
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready: return False
+        self.readEvents()
+        # Editors often write a file in several steps; wait for things to
+        # settle so that one save triggers one rebuild.
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], self.settle)
+            if not ready: break
+            self.readEvents()
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class AppWatcher(threading.Thread):
+    """Watches a package directory in the background. When it changes, calls
+    `recompile`, which returns the path of a new JSON file (or None if nothing
+    needs to change), and passes that path to `swap`."""
+
+    def __init__(self, watch_dir, recompile, swap):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.watch_dir = watch_dir
+        self.recompile = recompile
+        self.swap = swap
+        self.stopped = threading.Event()
+
+    def run(self):
+        watcher = FileWatcher(self.watch_dir)
+        print "Watching %s for changes." % self.watch_dir
+        try:
+            while not self.stopped.is_set():
+                if not watcher.wait(timeout=1.0): continue
+                try:
+                    json_path = self.recompile()
+                    if json_path is None: continue
+                    start = time.time()
+                    self.swap(json_path)
+                    print "Swapped in %s in %.2fs." % (json_path, time.time() - start)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            watcher.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def waitForInterrupt(self):
+        print "Press Ctrl-C to stop."
+        try:
+            while self.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
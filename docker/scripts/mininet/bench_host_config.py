@@ -0,0 +1,86 @@
+#!/usr/bin/env python2
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks host bring-up: how long Mininet's configHosts takes with P4Host,
+# which sets a host up with one command, and with a host that runs a command
+# per setting, as P4Host used to. Hosts are linked to each other in pairs, so
+# that no switches are needed. Must be run as root.
+
+import argparse
+import json
+import os
+
+from mininet.net import Mininet
+from mininet.node import Host
+from mininet.topo import Topo
+from mininet.log import setLogLevel
+
+from apptimings import monotonic
+from p4_mininet import P4Host
+
+RESULTS_FILENAME = 'host_config_bench.json'
+
+parser = argparse.ArgumentParser(description='Host bring-up benchmark')
+parser.add_argument('--hosts', help='Comma-separated numbers of hosts to bring up.',
+                    type=str, action='store', required=False, default='10,50,100,200')
+parser.add_argument('--log-dir', help='Directory to write the results to',
+                    type=str, action='store', required=False, default='/tmp/p4app_logs')
+
+class PerCommandHost(Host):
+    "The way P4Host used to be configured: Mininet's config, then a command per setting."
+    def config(self, **params):
+        r = super(PerCommandHost, self).config(**params)
+        for off in ["rx", "tx", "sg"]:
+            self.cmd("/sbin/ethtool --offload %s %s off" % (self.defaultIntf().name, off))
+        for intf in ["all", "default", "lo"]:
+            self.cmd("sysctl -w net.ipv6.conf.%s.disable_ipv6=1" % intf)
+        return r
+
+class PairsTopo(Topo):
+    def build(self, n):
+        for i in range(0, n, 2):
+            a = self.addHost('h%d' % (i + 1))
+            b = self.addHost('h%d' % (i + 2))
+            self.addLink(a, b)
+
+def bringUp(host_class, n):
+    net = Mininet(topo=None, host=host_class, controller=None, build=False)
+    try:
+        net.buildFromTopo(PairsTopo(n))
+        start = monotonic()
+        net.configHosts()
+        return monotonic() - start
+    finally:
+        net.stop()
+
+def main():
+    args = parser.parse_args()
+    setLogLevel('warning')
+    results = []
+    for n in [int(n) for n in args.hosts.split(',')]:
+        n += n % 2
+        for name, host_class in [('per-command', PerCommandHost), ('combined', P4Host)]:
+            seconds = bringUp(host_class, n)
+            results.append(dict(config=name, hosts=n, seconds=seconds, ms_per_host=seconds * 1e3 / n))
+            print '%-12s %5d hosts %8.3fs %8.2fms/host' % (name, n, seconds, seconds * 1e3 / n)
+
+    if not os.path.isdir(args.log_dir): os.makedirs(args.log_dir)
+    path = os.path.join(args.log_dir, RESULTS_FILENAME)
+    with open(path, 'w') as f:
+        json.dump(dict(results=results), f, indent=2)
+    print 'Saved the results to %s' % path
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks ShortestPath on a k-ary fat-tree, with the queries AppController
+# makes: every switch to every host (generateDefaultCommands) and every host to
+# every other host (configureHosts).
+
+import argparse
+import time
+
+from shortest_path import ShortestPath
+
+parser = argparse.ArgumentParser(description='ShortestPath benchmark')
+parser.add_argument('-k', help='Fat-tree arity (even). k=16 has 1344 nodes.',
+                    type=int, action='store', required=False, default=16)
+parser.add_argument('--host-pairs', help='Limit the number of host-to-host queries.',
+                    type=int, action='store', required=False, default=None)
+
+def fatTree(k):
+    half = k / 2
+    cores = ['c%d' % i for i in range(half * half)]
+    switches, hosts, edges = list(cores), [], []
+    for pod in range(k):
+        aggs = ['a%d_%d' % (pod, i) for i in range(half)]
+        edge_sws = ['e%d_%d' % (pod, i) for i in range(half)]
+        switches += aggs + edge_sws
+        for i, agg in enumerate(aggs):
+            for j in range(half):
+                edges.append((agg, cores[i * half + j]))
+            for e in edge_sws:
+                edges.append((e, agg))
+        for e in edge_sws:
+            for i in range(half):
+                h = 'h%d' % len(hosts)
+                hosts.append(h)
+                edges.append((h, e))
+    return switches, hosts, edges
+
+def timed(f):
+    start = time.time()
+    n = f()
+    return n, time.time() - start
+
+def main():
+    args = parser.parse_args()
+    switches, hosts, edges = fatTree(args.k)
+    print 'Fat-tree k=%d: %d switches, %d hosts, %d links' % (
+            args.k, len(switches), len(hosts), len(edges))
+
+    host_set = set(hosts)
+    is_host = lambda n: n in host_set
+    sp, build = timed(lambda: ShortestPath(edges))
+    print '%-28s %8.3fs' % ('build graph', build)
+
+    def switchToHost():
+        n = 0
+        for h in hosts:
+            for sw in switches:
+                sp.get(sw, h, exclude=is_host)
+                n += 1
+        return n
+
+    def hostToHost():
+        n = 0
+        for h in hosts:
+            for h2 in hosts:
+                if h == h2: continue
+                if args.host_pairs is not None and n >= args.host_pairs: return n
+                sp.get(h, h2, exclude=is_host)
+                n += 1
+        return n
+
+    for name, f in [('switch->host (cold)', switchToHost),
+                    ('switch->host (cached)', switchToHost),
+                    ('host->host (cached)', hostToHost)]:
+        n, seconds = timed(f)
+        print '%-28s %8.3fs %9d queries %8.2fus/query' % (name, seconds, n, seconds * 1e6 / max(n, 1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python2
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures how fast table entries can be written into a simple_switch: it
+# generates synthetic entries for the tables of a compiled program and loads
+# them with each of the ways the controller can talk to a switch.
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from apptimings import monotonic
+from entryfile import BmMatchParam, BmAddEntryOptions, matchParam, toBytes
+from switchsession import SwitchSession
+
+RESULTS_FILENAME = 'cp_bench.json'
+
+# cli: one simple_switch_CLI process per batch, as sendCommands used to do.
+# session: the in-process CLI that sendCommands uses now, one command at a time.
+# thrift: bm_mt_add_entry with entries that were encoded beforehand.
+PATHS = ['cli', 'session', 'thrift']
+
+parser = argparse.ArgumentParser(description='Control-plane write benchmark')
+parser.add_argument('--behavioral-exe', help='Path to behavioral executable',
+                    type=str, action="store", default='simple_switch')
+parser.add_argument('--cli-path', help='Path to the switch CLI',
+                    type=str, action="store", default='simple_switch_CLI')
+parser.add_argument('--json', help='Path to JSON config file',
+                    type=str, action="store", required=True)
+parser.add_argument('--thrift-port', help='Thrift server port for the switch',
+                    type=int, action="store", default=9090)
+parser.add_argument('--log-dir', help='Directory to write the results to',
+                    type=str, action="store", required=False, default='/tmp/p4app_logs')
+parser.add_argument('--tables', help='Comma-separated tables to fill. Defaults to all of them.',
+                    type=str, action="store", required=False, default=None)
+parser.add_argument('--entries', help='Comma-separated numbers of entries to write to each table.',
+                    type=str, action="store", required=False, default='1000')
+parser.add_argument('--batch', help='Commands per CLI process for the cli path.',
+                    type=int, action="store", required=False, default=1000)
+parser.add_argument('--paths', help='Comma-separated write paths to measure: %s.' % ', '.join(PATHS),
+                    type=str, action="store", required=False, default=','.join(PATHS))
+parser.add_argument('--baseline', help='Earlier results to compare with.',
+                    type=str, action="store", required=False, default=None)
+parser.add_argument('--tolerance', help='Fail if entries/s drops by more than this fraction.',
+                    type=float, action="store", required=False, default=0.2)
+
+class TableEntries:
+    """Makes distinct, valid entries for one table of a compiled program. The
+    entries differ in the table's widest key field; the other fields are 0
+    (or wildcards). Every entry uses the table's first action with
+    parameters, with every parameter set to 1."""
+
+    def __init__(self, program, table):
+        self.table = table
+        self.name = table['name']
+        headers = dict((h['name'], h['header_type']) for h in program['headers'])
+        header_types = dict((t['name'], dict((f[0], f[1]) for f in t['fields']))
+                            for t in program['header_types'])
+        self.keys = [(k['match_type'], header_types[headers[k['target'][0]]][k['target'][1]])
+                     for k in table['key']]
+        self.wide = max(range(len(self.keys)), key=lambda i: self.keys[i][1])
+        actions = dict((a['name'], a) for a in program['actions'])
+        candidates = [actions[name] for name in table['actions'] if name in actions]
+        action = ([a for a in candidates if a['runtime_data']] or candidates)[0]
+        self.action = action['name']
+        self.params = [p['bitwidth'] for p in action['runtime_data']]
+        self.priority = any(kind in ['ternary', 'range'] for kind, _ in self.keys)
+
+    def capacity(self):
+        return min(self.table.get('max_size', 1024), 1 << self.keys[self.wide][1])
+
+    def values(self, i):
+        return [(kind, width, i if k == self.wide else 0, k == self.wide)
+                for k, (kind, width) in enumerate(self.keys)]
+
+    def command(self, i):
+        match = []
+        for kind, width, value, wide in self.values(i):
+            if kind == 'lpm':
+                match.append('0x%x/%d' % (value, width))
+            elif kind == 'ternary':
+                match.append('0x%x&&&0x%x' % (value, (1 << width) - 1 if wide else 0))
+            elif kind == 'range':
+                match.append('0x%x->0x%x' % (value, value))
+            else:
+                match.append('0x%x' % value)
+        tokens = ['table_add', self.name, self.action] + match + ['=>'] + ['0x1' for _ in self.params]
+        if self.priority: tokens.append(str(i + 1))
+        return ' '.join(tokens)
+
+    def thriftArgs(self, i):
+        # The arguments for bm_mt_add_entry, after the context id.
+        match = []
+        for kind, width, value, wide in self.values(i):
+            key = toBytes(value, width)
+            if kind == 'lpm': extra = width
+            elif kind == 'ternary': extra = toBytes((1 << width) - 1 if wide else 0, width)
+            elif kind == 'range': extra = key
+            else: extra = None
+            match.append(matchParam(kind, key, extra))
+        params = [toBytes(1, width) for width in self.params]
+        options = BmAddEntryOptions(priority=i + 1 if self.priority else None)
+        return self.name, match, self.action, params, options
+
+def findTables(program, names=None):
+    tables = [t for p in program['pipelines'] for t in p['tables']]
+    if names is not None:
+        found = []
+        for name in names:
+            matches = [t for t in tables if t['name'] == name or t['name'].split('.')[-1] == name]
+            if len(matches) != 1:
+                raise Exception('%s table %s' % ('Ambiguous' if matches else 'Could not find', name))
+            found.append(matches[0])
+        tables = found
+    usable = []
+    for t in tables:
+        if t.get('type', 'simple') != 'simple' or not t['key']:
+            print 'Skipping %s: it has no key, or an action profile' % t['name']
+        elif any(k['match_type'] not in ['exact', 'lpm', 'ternary', 'range'] for k in t['key']):
+            print 'Skipping %s: it has a key that is not exact, lpm, ternary or range' % t['name']
+        else:
+            usable.append(t)
+    return usable
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+def rssKb(pid):
+    with open('/proc/%d/status' % pid, 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'): return int(line.split()[1])
+    return None
+
+def startSwitch(args, log_file):
+    p = subprocess.Popen([args.behavioral_exe, '--thrift-port', str(args.thrift_port),
+                          '--device-id', '0', args.json],
+                         stdout=log_file, stderr=subprocess.STDOUT)
+    # Poll with a growing delay, like P4Switch.batchStartup, so that waiting
+    # doesn't take a core from the switch while it starts.
+    deadline = monotonic() + 30
+    delay = 0.005
+    while monotonic() < deadline:
+        if p.poll() is not None:
+            raise Exception('The switch exited with status %d' % p.returncode)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(0.5)
+        if sock.connect_ex(('localhost', args.thrift_port)) == 0:
+            sock.close()
+            return p
+        sock.close()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    p.kill()
+    raise Exception('The switch did not start its Thrift server')
+
+def writeEntries(path, entries, n, session, batch):
+    # Returns the total time and the latency of each write, in seconds. With
+    # the cli path, each command's latency is its batch's time per command.
+    latencies = []
+    start = monotonic()
+    if path == 'cli':
+        for lo in range(0, n, batch):
+            commands = [entries.command(i) for i in range(lo, min(n, lo + batch))]
+            t = monotonic()
+            results = session.runCli(commands)
+            latencies += [(monotonic() - t) / len(commands)] * len(commands)
+            checkResults(results)
+    elif path == 'session':
+        commands = [entries.command(i) for i in range(n)]
+        start = monotonic()
+        for command in commands:
+            t = monotonic()
+            results = session.run([command])
+            latencies.append(monotonic() - t)
+            checkResults(results)
+    else:
+        calls = [entries.thriftArgs(i) for i in range(n)]
+        client = session.standard_client
+        start = monotonic()
+        for call in calls:
+            t = monotonic()
+            client.bm_mt_add_entry(0, *call)
+            latencies.append(monotonic() - t)
+    return monotonic() - start, latencies
+
+def checkResults(results):
+    for result in results:
+        if 'error' in result or 'handle' not in result:
+            raise Exception('Could not add an entry: %s' % result.get('error', result['raw'].strip()))
+
+def compare(results, baseline, tolerance):
+    # Returns the results that are more than `tolerance` slower than before.
+    before = dict(((r['path'], r['table'], r['requested']), r) for r in baseline['results'])
+    regressions = []
+    for r in results:
+        old = before.get((r['path'], r['table'], r['requested']))
+        if old is None: continue
+        ratio = r['entries_per_s'] / old['entries_per_s']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(r)
+            flag = '  REGRESSION'
+        print '%-8s %-30s %7d  %10.0f -> %10.0f entries/s (%+.0f%%)%s' % (
+                r['path'], r['table'], r['entries'], old['entries_per_s'],
+                r['entries_per_s'], (ratio - 1) * 100, flag)
+    return regressions
+
+def main(args):
+    with open(args.json, 'r') as f:
+        program = json.load(f)
+    names = [t.strip() for t in args.tables.split(',')] if args.tables else None
+    tables = [TableEntries(program, t) for t in findTables(program, names)]
+    sizes = [int(n) for n in args.entries.split(',')]
+    paths = [p.strip() for p in args.paths.split(',')]
+    for path in paths:
+        if path not in PATHS: raise Exception('Unknown write path: %s' % path)
+
+    session = SwitchSession(args.thrift_port, cli_path=args.cli_path, json_path=args.json)
+    if not session.inProcess() or BmMatchParam is None:
+        print 'The bmv2 Python modules are not available; only measuring the cli path.'
+        paths = [p for p in paths if p == 'cli']
+
+    if not os.path.isdir(args.log_dir): os.makedirs(args.log_dir)
+    results = []
+    with open(os.path.join(args.log_dir, 'cp_bench_switch.log'), 'w') as log_file:
+        switch = startSwitch(args, log_file)
+        try:
+            rss_idle = rssKb(switch.pid)
+            for size in sizes:
+                for entries in tables:
+                    n = min(size, entries.capacity())
+                    if n < size:
+                        print '%s only has room for %d entries' % (entries.name, n)
+                    for path in paths:
+                        session.run(['table_clear %s' % entries.name])
+                        seconds, latencies = writeEntries(path, entries, n, session, args.batch)
+                        result = dict(path=path, table=entries.name, entries=n, requested=size,
+                                      match_kinds=[kind for kind, _ in entries.keys],
+                                      seconds=seconds, entries_per_s=n / seconds,
+                                      p50_us=percentile(latencies, 0.5) * 1e6,
+                                      p99_us=percentile(latencies, 0.99) * 1e6,
+                                      rss_idle_kb=rss_idle, rss_kb=rssKb(switch.pid))
+                        results.append(result)
+                        print '%-8s %-30s %7d entries %8.3fs %10.0f entries/s  p50 %8.1fus  p99 %8.1fus  rss %dkB' % (
+                                path, entries.name, n, seconds, result['entries_per_s'],
+                                result['p50_us'], result['p99_us'], result['rss_kb'])
+                    session.run(['table_clear %s' % entries.name])
+        finally:
+            session.close()
+            switch.terminate()
+            switch.wait()
+
+    output = dict(program=os.path.basename(args.json), results=results)
+    path = os.path.join(args.log_dir, RESULTS_FILENAME)
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=2)
+    print 'Saved the results to %s' % path
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            print 'Writes got more than %d%% slower.' % (args.tolerance * 100)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python2
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A binary format for large sets of table entries, and a converter from
+# simple_switch_CLI command files:
+#
+#   entryfile.py --json program.json -o fib.p4entries commands.txt ...
+#
+# A file starts with MAGIC, then the length of a JSON header (4 bytes, big
+# endian), then the header, then the records of each section in turn. A
+# section holds the entries for one table and action; its records all have the
+# same layout, given by the key's match kinds and widths and the action's
+# parameter widths. A key field is its value in (width + 7) / 8 bytes, big
+# endian, followed for lpm by the prefix length (2 bytes), for ternary by the
+# mask and for range by the end of the range. Then come the action's
+# parameters, and, for tables with ternary or range keys, the priority
+# (4 bytes). Commands other than table_add are kept in the header, as text.
+
+import argparse
+import json
+import mmap
+import socket
+import struct
+import sys
+
+from switchstate import parseTableAdd
+
+try:
+    from bm_runtime.standard.ttypes import (BmMatchParam, BmMatchParamType, BmMatchParamExact,
+            BmMatchParamLPM, BmMatchParamTernary, BmMatchParamRange, BmMatchParamValid,
+            BmAddEntryOptions)
+except ImportError:
+    BmMatchParam = None
+
+MAGIC = 'P4ENTRY1'
+EXTENSION = '.p4entries'
+HEADER_LENGTH = struct.Struct('>I')
+
+def nbytes(width):
+    return (width + 7) / 8
+
+def toBytes(value, width):
+    n = nbytes(width)
+    return ''.join(chr((value >> (8 * i)) & 0xff) for i in reversed(range(n)))
+
+def fromBytes(s):
+    value = 0
+    for c in s:
+        value = (value << 8) | ord(c)
+    return value
+
+def parseValue(s, width):
+    # The same notations simple_switch_CLI accepts: IPv4, MAC and IPv6
+    # addresses for fields of their width, and integers in any base.
+    try:
+        if width == 32 and '.' in s:
+            value = fromBytes(socket.inet_aton(s))
+        elif width == 48 and ':' in s:
+            value = int(s.replace(':', ''), 16)
+        elif width == 128 and ':' in s:
+            value = fromBytes(socket.inet_pton(socket.AF_INET6, s))
+        else:
+            value = int(s, 0)
+    except (ValueError, socket.error):
+        raise Exception('Bad value for a %d-bit field: %s' % (width, s))
+    if value < 0 or value >= 1 << width:
+        raise Exception('%s does not fit in %d bits' % (s, width))
+    return value
+
+def fieldWidths(program):
+    headers = dict((h['name'], h['header_type']) for h in program['headers'])
+    header_types = dict((t['name'], dict((f[0], f[1]) for f in t['fields']))
+                        for t in program['header_types'])
+    def width(target):
+        if isinstance(target, basestring): return 1 # the header's validity
+        return header_types[headers[target[0]]][target[1]]
+    return width
+
+def findTable(program, name):
+    tables = [t for p in program['pipelines'] for t in p['tables']]
+    matches = [t for t in tables if t['name'] == name or t['name'].split('.')[-1] == name]
+    if len(matches) != 1:
+        raise Exception('%s table %s' % ('Ambiguous' if matches else 'Could not find', name))
+    return matches[0]
+
+def tableLayout(program, table_name, action_name):
+    "The section layout for entries of a table and action in a compiled program."
+    table = findTable(program, table_name)
+    width = fieldWidths(program)
+    actions = dict((a['name'], a) for a in program['actions'])
+    names = [a for a in table['actions'] if a == action_name or a.split('.')[-1] == action_name]
+    if len(names) != 1:
+        raise Exception('Table %s has no action %s' % (table['name'], action_name))
+    keys = [[k['match_type'], width(k['target'])] for k in table['key']]
+    return dict(table=table['name'], action=names[0], keys=keys,
+                params=[p['bitwidth'] for p in actions[names[0]]['runtime_data']],
+                priority=any(kind in ['ternary', 'range'] for kind, _ in keys))
+
+def recordStruct(section):
+    fmt = '>'
+    for kind, width in section['keys']:
+        fmt += '%ds' % nbytes(width)
+        if kind == 'lpm': fmt += 'H'
+        elif kind in ['ternary', 'range']: fmt += '%ds' % nbytes(width)
+    for width in section['params']:
+        fmt += '%ds' % nbytes(width)
+    if section['priority']: fmt += 'i'
+    return struct.Struct(fmt)
+
+def matchParam(kind, key, extra):
+    # A key field, as bm_mt_add_entry takes it. `extra` is the prefix length,
+    # the mask or the end of the range.
+    if kind == 'lpm':
+        return BmMatchParam(type=BmMatchParamType.LPM, lpm=BmMatchParamLPM(key, extra))
+    if kind == 'ternary':
+        return BmMatchParam(type=BmMatchParamType.TERNARY, ternary=BmMatchParamTernary(key, extra))
+    if kind == 'range':
+        return BmMatchParam(type=BmMatchParamType.RANGE, range=BmMatchParamRange(key, extra))
+    if kind == 'valid':
+        return BmMatchParam(type=BmMatchParamType.VALID, valid=BmMatchParamValid(key != '\0'))
+    return BmMatchParam(type=BmMatchParamType.EXACT, exact=BmMatchParamExact(key))
+
+class EntryFileWriter:
+    """Collects entries, then writes them as an entry file. Entries are given
+    as table_add commands or as already parsed values."""
+
+    def __init__(self, program):
+        self.program = program
+        self.sections = {} # (table, action) -> (layout, record struct, [packed records])
+        self.order = []
+        self.other = []
+
+    def addCommand(self, command):
+        tokens = command.split()
+        if not tokens: return
+        if tokens[0] != 'table_add':
+            self.other.append(command)
+            return
+        (table, match), (action, params, priority) = parseTableAdd(tokens)
+        self.add(table, action, match, params, priority)
+
+    def add(self, table, action, match, params, priority=None):
+        if (table, action) not in self.sections:
+            layout = tableLayout(self.program, table, action)
+            self.sections[(table, action)] = (layout, recordStruct(layout), [])
+            self.order.append((table, action))
+        section, record, records = self.sections[(table, action)]
+        if len(match) != len(section['keys']):
+            raise Exception('%s takes %d key fields, not %d' % (section['table'], len(section['keys']), len(match)))
+        if len(params) != len(section['params']):
+            raise Exception('%s takes %d parameters, not %d' % (section['action'], len(section['params']), len(params)))
+        values = []
+        for (kind, width), m in zip(section['keys'], match):
+            if kind == 'lpm':
+                value, prefix_len = m.split('/')
+                values += [toBytes(parseValue(value, width), width), int(prefix_len)]
+            elif kind == 'ternary':
+                value, mask = m.split('&&&')
+                values += [toBytes(parseValue(value, width), width), toBytes(parseValue(mask, width), width)]
+            elif kind == 'range':
+                start, end = m.split('->')
+                values += [toBytes(parseValue(start, width), width), toBytes(parseValue(end, width), width)]
+            else:
+                values.append(toBytes(parseValue(m, width), width))
+        values += [toBytes(parseValue(p, width), width) for p, width in zip(params, section['params'])]
+        if section['priority']:
+            if priority is None: raise Exception('%s needs a priority' % section['table'])
+            values.append(int(priority))
+        records.append(record.pack(*values))
+
+    def count(self):
+        return sum(len(records) for _, _, records in self.sections.values())
+
+    def write(self, path):
+        sections = []
+        for key in self.order:
+            section, _, records = self.sections[key]
+            sections.append(dict(section, count=len(records)))
+        header = json.dumps(dict(sections=sections, other=self.other))
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER_LENGTH.pack(len(header)))
+            f.write(header)
+            for key in self.order:
+                f.write(''.join(self.sections[key][2]))
+
+class EntryFile:
+    """Reads an entry file. The records are read straight out of a memory map,
+    one section at a time, so that large files don't have to fit in memory
+    as Python objects."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception('%s is not an entry file' % path)
+            length, = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+            header = json.loads(f.read(length))
+        self.sections = header['sections']
+        self.other = header['other']
+        self.data_offset = len(MAGIC) + HEADER_LENGTH.size + length
+
+    def count(self):
+        return sum(s['count'] for s in self.sections)
+
+    def validate(self, program):
+        "Check that the entries fit the tables and actions of a compiled program."
+        for section in self.sections:
+            expected = tableLayout(program, section['table'], section['action'])
+            for field in ['table', 'action', 'keys', 'params', 'priority']:
+                if expected[field] != section[field]:
+                    raise Exception('%s: the %s of %s/%s do not match the program: %s, not %s' % (
+                            self.path, field, section['table'], section['action'],
+                            expected[field], section[field]))
+
+    def records(self):
+        "(section, unpacked record) for every entry, in order."
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = self.data_offset
+                for section in self.sections:
+                    record = recordStruct(section)
+                    for i in xrange(section['count']):
+                        yield section, record.unpack_from(data, offset)
+                        offset += record.size
+            finally:
+                data.close()
+
+    def thriftCalls(self):
+        "The arguments for bm_mt_add_entry, after the context id, for every entry."
+        for section, values in self.records():
+            values, match = list(values), []
+            for kind, width in section['keys']:
+                if kind in ['lpm', 'ternary', 'range']:
+                    match.append(matchParam(kind, values[0], values[1]))
+                    values = values[2:]
+                else:
+                    match.append(matchParam(kind, values[0], None))
+                    values = values[1:]
+            params = values[:len(section['params'])]
+            priority = values[-1] if section['priority'] else None
+            yield (section['table'], match, section['action'], params,
+                   BmAddEntryOptions(priority=priority))
+
+    def commands(self):
+        "Every entry as a table_add command."
+        for section, values in self.records():
+            values, match = list(values), []
+            for kind, width in section['keys']:
+                if kind == 'lpm':
+                    match.append('0x%x/%d' % (fromBytes(values[0]), values[1]))
+                elif kind == 'ternary':
+                    match.append('0x%x&&&0x%x' % (fromBytes(values[0]), fromBytes(values[1])))
+                elif kind == 'range':
+                    match.append('0x%x->0x%x' % (fromBytes(values[0]), fromBytes(values[1])))
+                else:
+                    match.append('0x%x' % fromBytes(values[0]))
+                values = values[2:] if kind in ['lpm', 'ternary', 'range'] else values[1:]
+            params = ['0x%x' % fromBytes(p) for p in values[:len(section['params'])]]
+            tokens = ['table_add', section['table'], section['action']] + match + ['=>'] + params
+            if section['priority']: tokens.append(str(values[-1]))
+            yield ' '.join(tokens)
+
+parser = argparse.ArgumentParser(description='Convert simple_switch_CLI command files to an entry file')
+parser.add_argument('--json', help='The compiled program the entries are for',
+                    type=str, action="store", required=True)
+parser.add_argument('-o', '--output', help='The entry file to write',
+                    type=str, action="store", required=True)
+parser.add_argument('commands', help='Command files to convert', type=str, nargs='+')
+
+def main(args):
+    with open(args.json, 'r') as f:
+        writer = EntryFileWriter(json.load(f))
+    for filename in args.commands:
+        with open(filename, 'r') as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                try:
+                    writer.addCommand(line)
+                except Exception as e:
+                    print >> sys.stderr, '%s:%d: %s' % (filename, n, e)
+                    return 1
+    writer.write(args.output)
+    print 'Wrote %d entries and %d other commands to %s' % (writer.count(), len(writer.other), args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(parser.parse_args()))
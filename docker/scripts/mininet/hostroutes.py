@@ -0,0 +1,40 @@
+CONFLICT = object()
+
+def classfulPrefixLen(ip):
+    # The netmask ifconfig picks for an address when it isn't given one.
+    first = int(ip.split('.')[0])
+    if first < 128: return 8
+    if first < 192: return 16
+    return 24
+
+def aggregateRoutes(routes):
+    """Collapse a map from destination address to gateway into as few prefix
+    routes as the addressing plan allows. Addresses are grouped into /24s; a
+    /24 whose addresses all use the same gateway becomes one route, and
+    neighbouring /24s with the same gateway are merged, up to a /16. /24s that
+    nothing routes to (e.g. the host's own) can be covered by any route.
+    Addresses in a /24 that mixes gateways keep their own /32 route."""
+    blocks = {} # (a, b) -> {c: gateway, or CONFLICT}
+    for ip, gw in routes.iteritems():
+        a, b, c, _ = map(int, ip.split('.'))
+        block = blocks.setdefault((a, b), {})
+        block[c] = gw if block.get(c, gw) == gw else CONFLICT
+
+    result = []
+    for (a, b), block in sorted(blocks.iteritems()):
+        def cover(lo, size, prefix_len):
+            gws = set(block[c] for c in range(lo, lo + size)
+                      if c in block and block[c] is not CONFLICT)
+            if not gws: return
+            if len(gws) == 1:
+                result.append(('%d.%d.%d.0/%d' % (a, b, lo, prefix_len), gws.pop()))
+                return
+            cover(lo, size / 2, prefix_len + 1)
+            cover(lo + size / 2, size / 2, prefix_len + 1)
+        cover(0, 256, 16)
+
+    for ip, gw in sorted(routes.iteritems()):
+        a, b, c, _ = map(int, ip.split('.'))
+        if blocks[(a, b)][c] is CONFLICT:
+            result.append((ip + '/32', gw))
+    return result
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+def center(sp, switches, exclude):
+    # The switch whose furthest switch is the nearest, and then the one with
+    # the smallest total distance to the others. Ties go to the first one.
+    best, best_key = None, None
+    for sw in switches:
+        _, dist = sp.bfs(sw, exclude)
+        if any(other not in dist for other in switches):
+            continue # not connected to every switch
+        distances = [dist[other] for other in switches]
+        key = (max(distances), sum(distances))
+        if best_key is None or key < best_key:
+            best, best_key = sw, key
+    return best
+
+def spanningTree(sp, switches, exclude):
+    """A breadth-first spanning tree of the switches from the center of the
+    topology, as an OrderedDict from each switch to its parent, in the order
+    they were reached. Where a switch could hang off several parents at the
+    same depth, it takes the one with the fewest children so far, so that no
+    switch has to make many more copies than it needs to."""
+    root = center(sp, switches, exclude)
+    if root is None:
+        raise Exception("Can't build a multicast tree: the switches aren't all connected")
+    _, dist = sp.bfs(root, exclude)
+    order = dict((sw, i) for i, sw in enumerate(switches))
+    children = dict((sw, 0) for sw in switches)
+    parent = OrderedDict([(root, None)])
+    for sw in sorted((sw for sw in switches if sw != root), key=lambda sw: (dist[sw], order[sw])):
+        candidates = [n for n in sp.neighbors[sw] if n in children and dist[n] == dist[sw] - 1]
+        best = min(candidates, key=lambda n: (children[n], order[n]))
+        parent[sw] = best
+        children[best] += 1
+    return parent
+
+def pruneTree(parent, members):
+    """The edges of the spanning tree `parent` that are needed to connect the
+    switches in `members`: those with members on both sides."""
+    members = set(members)
+    below = dict((sw, 1 if sw in members else 0) for sw in parent)
+    for sw in reversed(parent.keys()):
+        if parent[sw] is not None: below[parent[sw]] += below[sw]
+    return [(parent[sw], sw) for sw in parent
+            if parent[sw] is not None and 0 < below[sw] < len(members)]
+
+if __name__ == '__main__':
+    from shortest_path import ShortestPath
+
+    # Two spines, three leaves, hosts h1..h3 on the leaves.
+    edges = [('s1', 's4'), ('s1', 's5'), ('s2', 's4'), ('s2', 's5'), ('s3', 's4'), ('s3', 's5'),
+             ('h1', 's1'), ('h2', 's2'), ('h3', 's3')]
+    sp = ShortestPath(edges)
+    switches = ['s1', 's2', 's3', 's4', 's5']
+    is_host = lambda n: n.startswith('h')
+
+    parent = spanningTree(sp, switches, is_host)
+    assert parent.keys()[0] == 's4'
+    assert parent['s5'] in ['s1', 's2', 's3']
+    assert sorted(sw for sw in parent if parent[sw] == 's4') == ['s1', 's2', 's3']
+
+    assert sorted(pruneTree(parent, ['s1', 's2', 's3'])) == [('s4', 's1'), ('s4', 's2'), ('s4', 's3')]
+    assert sorted(pruneTree(parent, ['s1', 's2'])) == [('s4', 's1'), ('s4', 's2')]
+    assert pruneTree(parent, ['s1']) == []
+
+    sp.removeEdge('s1', 's4')
+    parent = spanningTree(sp, switches, is_host)
+    assert parent.keys()[0] == 's5'
+    assert sorted(pruneTree(parent, ['s1', 's2', 's3'])) == [('s5', 's1'), ('s5', 's2'), ('s5', 's3')]
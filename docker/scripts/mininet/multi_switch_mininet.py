@@ -22,8 +22,10 @@ import subprocess
 import argparse
 import json
 import importlib
+import itertools
 import re
-from time import sleep
+import shutil
+from glob import glob
 
 from mininet.net import Mininet
 from mininet.topo import Topo
@@ -31,10 +33,14 @@ from mininet.link import TCLink
 from mininet.log import setLogLevel, info
 from mininet.cli import CLI
 
-from p4_mininet import P4Switch, P4Host
+from p4_mininet import P4Switch, P4Host, switchProfile, switchOptions, saveSwitchCommands
 import apptopo
 import appcontroller
 import appprocrunner
+from apptimings import AppTimings, monotonic
+from snapshots import saveSnapshot, SNAPSHOT_FILENAME
+from appwatcher import AppWatcher
+from appresources import AppResources
 
 parser = argparse.ArgumentParser(description='Mininet demo')
 parser.add_argument('--behavioral-exe', help='Path to behavioral executable',
@@ -55,28 +61,35 @@ parser.add_argument('--target', '-t', help='Target in manifest file to run',
                     type=str, action="store", required=True)
 parser.add_argument('--log-dir', '-l', help='Location to save output to',
                     type=str, action="store", required=True)
+parser.add_argument('--ipc-dir', help='Directory for the switches\' nanomsg IPC sockets',
+                    type=str, action="store", default='/tmp')
 
 
-args = parser.parse_args()
-
-
-next_thrift_port = args.thrift_port
-
 def run_command(command):
     return os.WEXITSTATUS(os.system(command))
 
-def configureP4Switch(**switch_args):
+def configureP4Switch(thrift_port, log_dir, switch_conf={}, resources=None, **switch_args):
+    # Each run hands out its own Thrift ports, so that several runs in the
+    # same process (or concurrent processes with different base ports) don't
+    # collide. `switch_conf` holds each switch's own settings from the manifest.
+    thrift_ports = itertools.count(thrift_port)
+
     class ConfiguredP4Switch(P4Switch):
-        def __init__(self, *opts, **kwargs):
-            global next_thrift_port
+        def __init__(self, name, *opts, **kwargs):
             kwargs.update(switch_args)
-            kwargs['thrift_port'] = next_thrift_port
-            next_thrift_port += 1
-            P4Switch.__init__(self, *opts, **kwargs)
+            kwargs.update(switchOptions(switch_conf.get(name, {})))
+            if resources: kwargs['launch_prefix'] = resources.prefix(name)
+            kwargs['thrift_port'] = next(thrift_ports)
+            kwargs['log_file'] = os.path.join(log_dir, 'p4s.%s.log' % name)
+            P4Switch.__init__(self, name, *opts, **kwargs)
     return ConfiguredP4Switch
 
 
-def main():
+def main(args, watch_dir=None, recompile=None):
+    # In watch mode, `recompile` is called whenever `watch_dir` changes; it
+    # returns the path of a new JSON file to swap into the running switches, or
+    # None if there's nothing to swap.
+    setLogLevel( 'info' )
 
     with open(args.manifest, 'r') as f:
         manifest = json.load(f)
@@ -116,6 +129,8 @@ def main():
         os.mkdir(args.log_dir)
     os.environ['P4APP_LOGDIR'] = args.log_dir
 
+    timings = AppTimings(args.log_dir)
+
 
     def formatLatency(lat):
         if isinstance(lat, (str, unicode)): return formatParams(lat)
@@ -138,12 +153,27 @@ def main():
     bmv2_log = args.bmv2_log or ('bmv2_log' in conf and conf['bmv2_log'])
     pcap_dump = args.pcap_dump or ('pcap_dump' in conf and conf['pcap_dump'])
 
+    # The profile sets the defaults; asking for the log or pcaps explicitly
+    # still turns them on.
+    profile = conf.get('profile', 'debug')
+    switch_opts = dict(sw_path=args.behavioral_exe, log_console=bmv2_log, pcap_dump=pcap_dump)
+    switch_opts.update(switchProfile(profile))
+    if bmv2_log: switch_opts['log_console'] = True
+    if pcap_dump: switch_opts['pcap_dump'] = True
+    switch_opts.update(switchOptions(conf))
+
     topo = AppTopo(manifest=manifest, target=args.target)
+    resources = None
+    if 'resources' in conf:
+        resources = AppResources(conf, topo.switches(), topo.hosts())
     switchClass = configureP4Switch(
-            sw_path=args.behavioral_exe,
+            args.thrift_port,
+            args.log_dir,
+            switch_conf=conf['switches'],
+            resources=resources,
             json_path=args.json,
-            log_console=bmv2_log,
-            pcap_dump=pcap_dump)
+            ipc_dir=args.ipc_dir,
+            **switch_opts)
     net = Mininet(topo = topo,
                   link = TCLink,
                   host = P4Host,
@@ -155,33 +185,99 @@ def main():
         controller = AppController(manifest=manifest, target=args.target,
                                      topo=topo, net=net, cli_path=args.cli_path)
 
-    net.start()
+    with timings.phase('net_start'):
+        net.start()
 
-    sleep(1)
+    for sw in net.switches:
+        if sw.start_time is not None and sw.ready_time is not None:
+            timings.recordSwitch(sw.name, 'startup', sw.start_time, sw.ready_time)
+    saveSwitchCommands(net.switches, args.log_dir, profile)
 
-    if controller: controller.start()
+    if controller:
+        with timings.phase('controller_start'):
+            controller.start()
+        for sw_name, (start, end) in controller.load_times.iteritems():
+            timings.recordSwitch(sw_name, 'control_plane', start, end)
 
 
     for h in net.hosts:
         h.describe()
 
-    if args.cli or ('cli' in conf and conf['cli']):
-        CLI(net)
-
-    proc_runner = AppProcRunner(manifest=manifest, target=args.target,
-                                    topo=topo, net=net, log_dir=args.log_dir)
+    cli = args.cli or ('cli' in conf and conf['cli'])
 
-    proc_runner.runall()
+    watcher = None
+    if recompile:
+        def swap(json_path):
+            if controller:
+                controller.hotSwap(json_path)
+            else:
+                for sw in net.switches:
+                    sw.loadNewConfig(json_path, args.cli_path)
+        watcher = AppWatcher(watch_dir, recompile, swap)
+        watcher.start()
 
-    if controller: controller.stop()
+    if cli and not watcher:
+        CLI(net)
 
-    net.stop()
+    proc_runner = AppProcRunner(manifest=manifest, target=args.target,
+                                    topo=topo, net=net, log_dir=args.log_dir,
+                                    resources=resources)
+
+    hold = None
+    if watcher:
+        # Keep the network and the hosts' processes up until the user is done.
+        hold = (lambda: CLI(net)) if cli else watcher.waitForInterrupt
+
+    with timings.phase('procs_run'):
+        if hold: proc_runner.runall(hold=hold)
+        else:    proc_runner.runall()
+
+    if watcher: watcher.stop()
+
+    if controller and conf.get('snapshot'):
+        # Keep the switches' final state for analysis after they're gone.
+        spec = conf['snapshot'] if isinstance(conf['snapshot'], dict) else {}
+        try:
+            with timings.phase('snapshot'):
+                snapshot = controller.snapshot(registers=spec.get('registers'),
+                                               counters=spec.get('counters'),
+                                               meters=spec.get('meters'))
+                path = saveSnapshot(snapshot, os.path.join(args.log_dir, SNAPSHOT_FILENAME))
+            print "Saved the switches' registers, counters and meters to", path
+        except Exception as e:
+            print 'Could not take a snapshot of the switches: %s' % e
+
+    if controller:
+        with timings.phase('controller_stop'):
+            controller.stop()
+        if controller.link_events:
+            with open(os.path.join(args.log_dir, 'link_events.json'), 'w') as f:
+                json.dump(controller.link_events, f, indent=2)
+
+    net_stop_start = monotonic()
+    with timings.phase('net_stop'):
+        net.stop()
+
+    # Teardown runs from interrupting the hosts' commands to the end of
+    # net.stop(); the phases in between break it down.
+    if proc_runner.kill_start is not None:
+        timings.record('procs_kill', proc_runner.kill_start, proc_runner.kill_end)
+    teardown_start, teardown_end = proc_runner.kill_start or net_stop_start, monotonic()
+    timings.record('teardown', teardown_start, teardown_end)
+    print 'Teardown took %.2fs' % (teardown_end - teardown_start)
+
+    if resources:
+        print "Saved each switch's and host's CPU and memory use to", resources.save(args.log_dir)
+        resources.close()
+
+    timings.save()
 
     if pcap_dump:
-        os.system('bash -c "cp *.pcap \'%s\'"' % args.log_dir)
+        for pcap in glob('*.pcap'):
+            shutil.copy(pcap, args.log_dir)
 
-    if proc_runner.hadError(): sys.exit(1)
+    if proc_runner.hadError(): return 1
+    return 0
 
 if __name__ == '__main__':
-    setLogLevel( 'info' )
-    main()
+    sys.exit(main(parser.parse_args()))
@@ -19,22 +19,105 @@ from mininet.log import setLogLevel, info, error, debug
 from mininet.moduledeps import pathCheck
 from sys import exit
 import os
+import json
+import pipes
+import shlex
 import tempfile
 import socket
+import subprocess
+from signal import SIGTERM, SIGKILL
+from time import sleep
 
-class P4Host(Host):
-    def config(self, **params):
-        r = super(P4Host, self).config(**params)
+from apptimings import monotonic
+
+# The prefix length Mininet's setIP uses for an address given without one.
+DEFAULT_PREFIX_LEN = 8
+
+# How long a switch may take to start its Thrift server.
+STARTUP_TIMEOUT = 60
+# How long the switches may take to exit before they're killed.
+SHUTDOWN_TIMEOUT = 5
+
+# P4Switch options for each manifest "profile". Every one of the options the
+# throughput profile turns off costs bmv2 time on every packet.
+SWITCH_PROFILES = {
+    'debug': {},
+    'throughput': dict(log_console=False, enable_debugger=False, nanolog=False, pcap_dump=False),
+}
+
+SWITCH_COMMANDS_FILENAME = 'switch_commands.json'
 
-        for off in ["rx", "tx", "sg"]:
-            cmd = "/sbin/ethtool --offload %s %s off" % (self.defaultIntf().name, off)
-            self.cmd(cmd)
+def switchProfile(name):
+    if name not in SWITCH_PROFILES:
+        raise Exception('Unknown switch profile: %s (expected one of %s)' % (
+                name, ', '.join(sorted(SWITCH_PROFILES))))
+    return dict(SWITCH_PROFILES[name])
 
-        # disable IPv6
-        self.cmd("sysctl -w net.ipv6.conf.all.disable_ipv6=1")
-        self.cmd("sysctl -w net.ipv6.conf.default.disable_ipv6=1")
-        self.cmd("sysctl -w net.ipv6.conf.lo.disable_ipv6=1")
+def switchOptions(conf):
+    "P4Switch options from the switch settings of a manifest target or switch."
+    options = {}
+    if 'behavioral_exe' in conf: options['sw_path'] = conf['behavioral_exe']
+    if 'log_level' in conf: options['log_level'] = conf['log_level']
+    for key in ['switch_args', 'target_args']:
+        if key not in conf: continue
+        value = conf[key]
+        if isinstance(value, basestring): options[key] = shlex.split(value)
+        else: options[key] = [str(a) for a in value]
+    return options
 
+def saveSwitchCommands(switches, log_dir, profile=None):
+    "Record the command line each switch was started with."
+    commands = dict((sw.name, sw.command) for sw in switches if getattr(sw, 'command', None))
+    path = os.path.join(log_dir, SWITCH_COMMANDS_FILENAME)
+    with open(path, 'w') as f:
+        json.dump(dict(profile=profile, switches=commands), f, indent=2)
+    return path
+
+def hostSetupCommand(intf, mac=None, ip=None, default_route=None, lo='up'):
+    """One shell command that does everything Host.config and P4Host need to
+    set up a host: the interface's MAC and IP address, the default route, the
+    loopback interface, no offloads and no IPv6."""
+    cmds = []
+    if intf is not None:
+        if mac:
+            cmds += ['ip link set dev %s down' % intf,
+                     'ip link set dev %s address %s' % (intf, mac),
+                     'ip link set dev %s up' % intf]
+        if ip:
+            if '/' not in ip: ip = '%s/%d' % (ip, DEFAULT_PREFIX_LEN)
+            cmds += ['ip addr flush dev %s' % intf,
+                     'ip addr add %s broadcast + dev %s' % (ip, intf),
+                     'ip link set dev %s up' % intf]
+        if default_route:
+            route = default_route if ' ' in default_route else 'dev %s' % default_route
+            cmds.append('ip route replace default %s' % route)
+        cmds.append('/sbin/ethtool --offload %s rx off tx off sg off' % intf)
+    if lo:
+        cmds.append('ifconfig lo %s' % lo)
+    cmds.append('sysctl -q -w ' + ' '.join('net.ipv6.conf.%s.disable_ipv6=1' % i
+                                            for i in ['all', 'default', 'lo']))
+    return '; '.join(cmds)
+
+class P4Host(Host):
+    def config(self, mac=None, ip=None, defaultRoute=None, lo='up', **params):
+        # Mininet would run a command in the host's shell for each setting.
+        # With hundreds of hosts those round-trips add up, so set the host up
+        # with a single command. Settings given per interface (as dicts or
+        # lists) are still left to Mininet.
+        r = {}
+        if not all(v is None or isinstance(v, basestring) for v in [mac, ip, defaultRoute]):
+            r = super(P4Host, self).config(mac=mac, ip=ip, defaultRoute=defaultRoute, lo=lo, **params)
+            mac = ip = defaultRoute = lo = None
+
+        intf = self.defaultIntf()
+        r['setup'] = self.cmd(hostSetupCommand(intf.name if intf else None,
+                                               mac, ip, defaultRoute, lo))
+        # Keep Mininet's view of the interface in step.
+        if intf and mac:
+            intf.mac = mac
+        if intf and ip:
+            intf.ip, prefix_len = ip.split('/') if '/' in ip else (ip, DEFAULT_PREFIX_LEN)
+            intf.prefixLen = int(prefix_len)
         return r
 
     def describe(self, sw_addr=None, sw_mac=None):
@@ -61,6 +144,12 @@ class P4Switch(Switch):
                  verbose = False,
                  device_id = None,
                  enable_debugger = False,
+                 ipc_dir = '/tmp',
+                 nanolog = True,
+                 log_level = None,
+                 switch_args = [],
+                 target_args = [],
+                 launch_prefix = [],
                  **kwargs):
         Switch.__init__(self, name, **kwargs)
         assert(sw_path)
@@ -88,30 +177,72 @@ class P4Switch(Switch):
         else:
             self.device_id = P4Switch.device_id
             P4Switch.device_id += 1
-        self.nanomsg = "ipc:///tmp/bm-{}-log.ipc".format(self.device_id)
+        self.nanomsg = None
+        if nanolog:
+            self.nanomsg = "ipc://{}/bm-{}-log.ipc".format(ipc_dir, self.device_id)
+        self.log_level = log_level
+        self.switch_args = list(switch_args)
+        self.target_args = list(target_args)
+        self.launch_prefix = list(launch_prefix)
+        self.command = None
+        self.pid = None
+        self.start_time = None
+        self.ready_time = None
 
     @classmethod
     def setup(cls):
         pass
 
-    def check_switch_started(self, pid):
-        """While the process is running (pid exists), we check if the Thrift
-        server has been started. If the Thrift server is ready, we assume that
-        the switch was started successfully. This is only reliable if the Thrift
-        server is started at the end of the init process"""
+    def thrift_ready(self):
+        """If the Thrift server has been started, we assume that the switch was
+        started successfully. This is only reliable if the Thrift server is
+        started at the end of the init process"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            return sock.connect_ex(("localhost", self.thrift_port)) == 0
+        finally:
+            sock.close()
+
+    def process_exited(self):
+        # The switch runs in the background of the node's shell, which may not
+        # have reaped it yet.
+        try:
+            with open(os.path.join("/proc", str(self.pid), "stat")) as f:
+                return f.read().rsplit(')', 1)[1].split()[0] == 'Z'
+        except IOError:
+            return True
+
+    @classmethod
+    def batchStartup(cls, switches, **_kwargs):
+        """Mininet calls this once start() has launched every switch. Waits
+        for all of them to come up at once, checking each one's Thrift server
+        with a growing delay between rounds."""
+        pending = [sw for sw in switches if sw.ready_time is None]
+        deadline = monotonic() + STARTUP_TIMEOUT
+        delay = 0.005
         while True:
-            if not os.path.exists(os.path.join("/proc", str(pid))):
-                return False
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(0.5)
-            result = sock.connect_ex(("localhost", self.thrift_port))
-            if result == 0:
-                return  True
+            for sw in list(pending):
+                if sw.thrift_port is None or sw.thrift_ready():
+                    sw.ready_time = monotonic()
+                    info("P4 switch {} has been started.\n".format(sw.name))
+                    pending.remove(sw)
+                elif sw.process_exited():
+                    error("P4 switch {} did not start correctly. See {}.\n".format(sw.name, sw.log_file))
+                    exit(1)
+            if not pending: return switches
+            if monotonic() > deadline:
+                error("P4 switches {} did not start within {}s.\n".format(
+                        ' '.join(sw.name for sw in pending), STARTUP_TIMEOUT))
+                exit(1)
+            sleep(delay)
+            delay = min(delay * 2, 0.1)
 
     def start(self, controllers):
-        "Start up a new P4 switch"
+        "Start up a new P4 switch. batchStartup() waits for it to be ready."
         info("Starting P4 switch {}.\n".format(self.name))
-        args = [self.sw_path]
+        self.start_time = monotonic()
+        # e.g. to start the switch in a cgroup, or pinned to some CPUs
+        args = self.launch_prefix + [self.sw_path]
         for port, intf in self.intfs.items():
             if not intf.IP():
                 args.extend(['-i', str(port) + "@" + intf.name])
@@ -124,30 +255,71 @@ class P4Switch(Switch):
             args.extend(['--nanolog', self.nanomsg])
         args.extend(['--device-id', str(self.device_id)])
         P4Switch.device_id += 1
+        if self.log_level:
+            args.extend(['--log-level', self.log_level])
+        args.extend(self.switch_args)
         args.append(self.json_path)
         if self.enable_debugger:
             args.append("--debugger")
         if self.log_console:
             args.append("--log-console")
+        if self.target_args:
+            args.append('--')
+            args.extend(self.target_args)
+        self.command = args
         info(' '.join(args) + "\n")
 
-        pid = None
+        self.ready_time = None
         with tempfile.NamedTemporaryFile() as f:
             # self.cmd(' '.join(args) + ' > /dev/null 2>&1 &')
-            self.cmd(' '.join(args) + ' >' + self.log_file + ' 2>&1 & echo $! >> ' + f.name)
-            pid = int(f.read())
-        debug("P4 switch {} PID is {}.\n".format(self.name, pid))
-        if not self.check_switch_started(pid):
-            error("P4 switch {} did not start correctly.\n".format(self.name))
-            exit(1)
-        info("P4 switch {} has been started.\n".format(self.name))
+            self.cmd(' '.join(pipes.quote(a) for a in args) + ' >' + self.log_file + ' 2>&1 & echo $! >> ' + f.name)
+            self.pid = int(f.read())
+        debug("P4 switch {} PID is {}.\n".format(self.name, self.pid))
+
+    def loadNewConfig(self, json_path, cli_path='simple_switch_CLI', commands=[]):
+        "Swap a new JSON program into the running switch, then run `commands`."
+        p = subprocess.Popen([cli_path, '--thrift-port', str(self.thrift_port)],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdout, _ = p.communicate(input='\n'.join(
+            ['load_new_config_file %s' % json_path, 'swap_configs'] + commands))
+        debug(stdout)
+        self.json_path = json_path
+        return p.returncode == 0
+
+    def send_signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except OSError:
+            pass # it has already exited
+
+    @classmethod
+    def batchShutdown(cls, switches, **_kwargs):
+        """Mininet calls this to stop the switches. Signals all of them at
+        once and waits for them to exit together; any switch still running
+        after SHUTDOWN_TIMEOUT is killed."""
+        pending = []
+        for sw in switches:
+            sw.output.flush()
+            if sw.pid:
+                sw.send_signal(SIGTERM)
+                pending.append(sw)
+        deadline = monotonic() + SHUTDOWN_TIMEOUT
+        delay = 0.005
+        while True:
+            pending = [sw for sw in pending if not sw.process_exited()]
+            if not pending or monotonic() > deadline: break
+            sleep(delay)
+            delay = min(delay * 2, 0.1)
+        for sw in pending:
+            error("P4 switch {} did not stop within {}s; killing it.\n".format(sw.name, SHUTDOWN_TIMEOUT))
+            sw.send_signal(SIGKILL)
+        for sw in switches:
+            sw.deleteIntfs()
+        return switches
 
     def stop(self):
         "Terminate P4 switch."
-        self.output.flush()
-        self.cmd('kill %' + self.sw_path)
-        self.cmd('wait')
-        self.deleteIntfs()
+        self.batchShutdown([self])
 
     def attach(self, intf):
         "Connect a data port"
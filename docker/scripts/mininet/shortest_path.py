@@ -1,33 +1,93 @@
+from collections import deque
+
+# How many distinct `exclude` predicates to keep trees for. Callers should
+# pass the same predicate object every time; this keeps callers that don't
+# from growing the cache forever.
+MAX_EXCLUDE_PREDICATES = 8
+
+def noExclude(node):
+    return False
+
 class ShortestPath:
 
     def __init__(self, edges=[]):
         self.neighbors = {}
+        # exclude -> dest -> ({node: next hop towards dest}, {node: distance to dest})
+        self.trees = {}
         for edge in edges:
-            self.addEdge(*edge)
+            self.addEdge(edge[0], edge[1])
 
     def addEdge(self, a, b):
+        # Returns the destinations whose shortest paths may have changed.
         if a not in self.neighbors: self.neighbors[a] = []
         if b not in self.neighbors[a]: self.neighbors[a].append(b)
 
         if b not in self.neighbors: self.neighbors[b] = []
         if a not in self.neighbors[b]: self.neighbors[b].append(a)
 
-    def get(self, a, b, exclude=lambda node: False):
-        # Shortest path from a to b
-        return self._recPath(a, b, [], exclude)
-
-    def _recPath(self, a, b, visited, exclude):
+        # The new edge is a shortcut, or an equal-cost alternative, unless
+        # both ends are as far from the destination (or both unreachable).
+        return self.invalidate(lambda dist: dist.get(a) != dist.get(b))
+
+    def removeEdge(self, a, b):
+        # Returns the destinations whose shortest paths may have changed.
+        if b in self.neighbors.get(a, []): self.neighbors[a].remove(b)
+        if a in self.neighbors.get(b, []): self.neighbors[b].remove(a)
+
+        # Only trees in which the edge was on some shortest path change.
+        return self.invalidate(lambda dist: a in dist and b in dist and abs(dist[a] - dist[b]) == 1)
+
+    def invalidate(self, affected):
+        dests = set()
+        for trees in self.trees.values():
+            for dest, (_, dist) in trees.items():
+                if affected(dist):
+                    del trees[dest]
+                    dests.add(dest)
+        return dests
+
+    def get(self, a, b, exclude=noExclude):
+        # Shortest path from a to b. Nodes for which `exclude` returns True
+        # can be the ends of a path, but aren't used in the middle of one.
         if a == b: return [a]
-        new_visited = visited + [a]
-        paths = []
-        for neighbor in self.neighbors[a]:
-            if neighbor in new_visited: continue
-            if exclude(neighbor) and neighbor != b: continue
-            path = self._recPath(neighbor, b, new_visited, exclude)
-            if path: paths.append(path)
-
-        paths.sort(key=len)
-        return [a] + paths[0] if len(paths) else None
+        next_hop, _ = self.tree(b, exclude)
+        if a not in next_hop: return None
+        path = [a]
+        while path[-1] != b:
+            path.append(next_hop[path[-1]])
+        return path
+
+    def nextHops(self, a, b, exclude=noExclude):
+        # Every neighbor of a that is on some shortest path from a to b.
+        if a == b: return []
+        _, dist = self.tree(b, exclude)
+        if a not in dist: return []
+        return [n for n in self.neighbors[a]
+                if n == b or (dist.get(n) == dist[a] - 1 and not exclude(n))]
+
+    def tree(self, dest, exclude=noExclude):
+        if exclude not in self.trees:
+            if len(self.trees) >= MAX_EXCLUDE_PREDICATES: self.trees = {}
+            self.trees[exclude] = {}
+        trees = self.trees[exclude]
+        if dest not in trees:
+            trees[dest] = self.bfs(dest, exclude)
+        return trees[dest]
+
+    def bfs(self, dest, exclude):
+        # Breadth-first search outwards from dest; each node we reach records
+        # the neighbor it was reached from, which is its next hop to dest.
+        next_hop, dist = {}, {dest: 0}
+        if dest not in self.neighbors: return next_hop, dist
+        queue = deque([dest])
+        while queue:
+            node = queue.popleft()
+            for neighbor in self.neighbors[node]:
+                if neighbor in dist: continue
+                dist[neighbor] = dist[node] + 1
+                next_hop[neighbor] = node
+                if not exclude(neighbor): queue.append(neighbor)
+        return next_hop, dist
 
 if __name__ == '__main__':
 
@@ -76,3 +136,16 @@ if __name__ == '__main__':
     assert sp.get(1, 7) == None
     assert sp.get(7, 2) == None
 
+    assert sorted(sp.nextHops(1, 6)) == [3, 5]
+    assert sorted(sp.nextHops(2, 6)) == [4]
+    assert sp.nextHops(1, 1) == []
+    assert sp.nextHops(1, 7) == []
+
+    sp = ShortestPath(edges)
+    sp.get(2, 4)
+    sp.get(5, 6)
+    sp.get(8, 7)
+    assert sp.removeEdge(2, 4) == set([4, 6])
+    assert sp.get(2, 4) == [2, 1, 3, 4]
+    assert sp.addEdge(2, 4) == set([4])
+    assert sp.get(2, 4) == [2, 4]
@@ -20,12 +20,17 @@ from mininet.topo import Topo
 from mininet.log import setLogLevel, info
 from mininet.cli import CLI
 
-from p4_mininet import P4Switch, P4Host
+from p4_mininet import P4Switch, P4Host, switchProfile, saveSwitchCommands
+from apptimings import AppTimings, monotonic
+from appwatcher import AppWatcher
 
 import argparse
 import os
+import shlex
+import shutil
+import sys
+from glob import glob
 from subprocess import PIPE, Popen
-from time import sleep
 
 parser = argparse.ArgumentParser(description='Mininet demo')
 parser.add_argument('--behavioral-exe', help='Path to behavioral executable',
@@ -45,25 +50,36 @@ parser.add_argument('--switch-config', help='simple_switch_CLI script to configu
                     type=str, action="store", required=False, default=False)
 parser.add_argument('--cli-message', help='Message to print before starting CLI',
                     type=str, action="store", required=False, default=False)
-
-args = parser.parse_args()
+parser.add_argument('--ipc-dir', help='Directory for the switch\'s nanomsg IPC socket',
+                    type=str, action="store", required=False, default='/tmp')
+parser.add_argument('--log-dir', help='Directory to copy pcap files to',
+                    type=str, action="store", required=False, default='/tmp/p4app_logs')
+parser.add_argument('--profile', help='Switch profile: debug or throughput',
+                    type=str, action="store", required=False, default='debug')
+parser.add_argument('--log-level', help='Switch log level',
+                    type=str, action="store", required=False, default=None)
+parser.add_argument('--switch-args', help='Extra options for the switch',
+                    type=str, action="store", required=False, default='')
+parser.add_argument('--target-args', help='Extra target-specific options for the switch',
+                    type=str, action="store", required=False, default='')
 
 
 class SingleSwitchTopo(Topo):
     "Single switch connected to n (< 256) hosts."
     def __init__(self, sw_path, json_path, log_file,
-                 thrift_port, pcap_dump, n, **opts):
+                 thrift_port, pcap_dump, n, ipc_dir='/tmp', switch_opts={}, **opts):
         # Initialize topology and default options
         Topo.__init__(self, **opts)
 
+        switch_opts = dict(dict(log_console = True, enable_debugger = True), **switch_opts)
+        if pcap_dump: switch_opts['pcap_dump'] = True
         switch = self.addSwitch('s1',
                                 sw_path = sw_path,
                                 json_path = json_path,
-                                log_console = True,
                                 log_file = log_file,
                                 thrift_port = thrift_port,
-                                enable_debugger = True,
-                                pcap_dump = pcap_dump)
+                                ipc_dir = ipc_dir,
+                                **switch_opts)
 
         for h in xrange(n):
             host = self.addHost('h%d' % (h + 1),
@@ -72,22 +88,40 @@ class SingleSwitchTopo(Topo):
             print "Adding host", str(host)
             self.addLink(host, switch)
 
-def main():
+def main(args, watch_dir=None, recompile=None):
+    # In watch mode, `recompile` is called whenever `watch_dir` changes; it
+    # returns the path of a new JSON file to swap into the running switch, or
+    # None if there's nothing to swap.
+    setLogLevel( 'info' )
     num_hosts = args.num_hosts
     mode = args.mode
 
+    switch_opts = switchProfile(args.profile)
+    switch_opts.update(log_level = args.log_level,
+                       switch_args = shlex.split(args.switch_args),
+                       target_args = shlex.split(args.target_args))
+
     topo = SingleSwitchTopo(args.behavioral_exe,
                             args.json,
                             args.log_file,
                             args.thrift_port,
                             args.pcap_dump,
-                            num_hosts)
+                            num_hosts,
+                            ipc_dir = args.ipc_dir,
+                            switch_opts = switch_opts)
     net = Mininet(topo = topo,
                   host = P4Host,
                   switch = P4Switch,
                   controller = None)
-    net.start()
 
+    timings = AppTimings(args.log_dir)
+    with timings.phase('net_start'):
+        net.start()
+
+    for sw in net.switches:
+        if sw.start_time is not None and sw.ready_time is not None:
+            timings.recordSwitch(sw.name, 'startup', sw.start_time, sw.ready_time)
+    saveSwitchCommands(net.switches, args.log_dir, args.profile)
 
     sw_mac = ["00:aa:bb:00:00:%02x" % n for n in xrange(num_hosts)]
 
@@ -105,8 +139,6 @@ def main():
         h = net.get('h%d' % (n + 1))
         h.describe(sw_addr[n], sw_mac[n])
 
-    sleep(1)
-
     if args.switch_config is not None:
         print
         print "Reading switch configuration script:", args.switch_config
@@ -114,8 +146,12 @@ def main():
             switch_config = config_file.read()
 
         print "Configuring switch..."
-        proc = Popen(["simple_switch_CLI"], stdin=PIPE)
+        start = monotonic()
+        proc = Popen(["simple_switch_CLI", "--thrift-port", str(args.thrift_port)], stdin=PIPE)
         proc.communicate(input=switch_config)
+        end = monotonic()
+        timings.record('switch_config', start, end)
+        timings.recordSwitch('s1', 'control_plane', start, end)
 
         print "Configuration complete."
         print
@@ -126,12 +162,33 @@ def main():
         with open(args.cli_message, 'r') as message_file:
             print message_file.read()
 
-    CLI( net )
-    net.stop()
+    watcher = None
+    if recompile:
+        def swap(json_path):
+            # Replay the switch configuration: table entries don't survive the swap.
+            commands = []
+            if args.switch_config:
+                with open(args.switch_config, 'r') as config_file:
+                    commands = config_file.read().splitlines()
+            net.get('s1').loadNewConfig(json_path, commands=commands)
+        watcher = AppWatcher(watch_dir, recompile, swap)
+        watcher.start()
+
+    with timings.phase('cli'):
+        CLI( net )
+
+    if watcher: watcher.stop()
+
+    with timings.phase('net_stop'):
+        net.stop()
+
+    timings.save()
 
     if args.pcap_dump:
-        os.system('bash -c "cp *.pcap \'%s\'"' % '/tmp/p4app_logs')
+        for pcap in glob('*.pcap'):
+            shutil.copy(pcap, args.log_dir)
+
+    return 0
 
 if __name__ == '__main__':
-    setLogLevel( 'info' )
-    main()
+    sys.exit(main(parser.parse_args()))
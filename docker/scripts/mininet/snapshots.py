@@ -0,0 +1,46 @@
+import json
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SNAPSHOT_FILENAME = 'snapshot.npz'
+
+def toColumn(values, dtype):
+    # A NumPy array if NumPy is installed, otherwise the list as it is.
+    if numpy is None: return values
+    return numpy.array(values, dtype=dtype)
+
+def saveSnapshot(snapshot, path=None):
+    """Write a snapshot (switch -> column name -> values) to a compressed .npz
+    file, one array per switch and column, named <switch>/<column>. Without
+    NumPy, writes JSON next to it instead. Returns the path written."""
+    if path is None:
+        path = os.path.join(os.environ.get('P4APP_LOGDIR', '.'), SNAPSHOT_FILENAME)
+    arrays = dict(('%s/%s' % (sw, column), values)
+                  for sw, columns in snapshot.iteritems()
+                  for column, values in columns.iteritems())
+    if numpy is None:
+        path = os.path.splitext(path)[0] + '.json'
+        with open(path, 'w') as f:
+            json.dump(arrays, f)
+    else:
+        # savez would add .npz to a path without it.
+        with open(path, 'wb') as f:
+            numpy.savez_compressed(f, **arrays)
+    return path
+
+def loadSnapshot(path):
+    "Read a file written by saveSnapshot back into switch -> column -> array."
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            arrays = json.load(f)
+    else:
+        arrays = numpy.load(path)
+    snapshot = {}
+    for key in arrays.keys():
+        sw, column = key.split('/', 1)
+        snapshot.setdefault(sw, {})[column] = arrays[key]
+    return snapshot
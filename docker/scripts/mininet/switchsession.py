@@ -0,0 +1,280 @@
+import hashlib
+import json
+import re
+import subprocess
+import sys
+import threading
+from StringIO import StringIO
+
+try:
+    import runtime_CLI
+    from sswitch_CLI import SimpleSwitchAPI
+except ImportError:
+    runtime_CLI = None
+
+# The runtime CLI catches the errors of a command and prints them, e.g.
+# "Error: Table 'foo' not found", "Invalid table operation (DUPLICATE_ENTRY)"
+# or, for an unknown command, "*** Unknown syntax: foo".
+CLI_ERROR = re.compile(r'^\s*(Error:|Invalid |\*\*\* Unknown syntax)', re.MULTILINE)
+
+def parseCliOutput(s):
+    parsed = dict(raw=s)
+    # mc_node_create says "node was created with handle N", table_add says
+    # "Entry has been added with handle N".
+    for marker in ['created with handle', 'added with handle']:
+        if marker in s:
+            parsed['handle'] = int(s.split(marker, 1)[-1].split()[0])
+    m = CLI_ERROR.search(s)
+    if m:
+        parsed['error'] = s[m.start():].strip().split('\n', 1)[0]
+    return parsed
+
+def findArray(program, kind, name):
+    # kind is register_arrays, counter_arrays or meter_arrays. Names in the
+    # JSON are qualified by their control (ingress.hits); the bare name works
+    # too, as long as only one array has it.
+    arrays = program.get(kind, [])
+    for array in arrays:
+        if array['name'] == name: return array
+    matches = [a for a in arrays if a['name'].split('.')[-1] == name]
+    if len(matches) != 1:
+        raise Exception('%s %s in the switch\'s program' % (
+                'Ambiguous name' if matches else 'Could not find', name))
+    return matches[0]
+
+def arrayNames(program, kind, names=None):
+    # The arrays to read: the given ones, or all of them. Direct counters and
+    # meters belong to table entries, so they can't be read by index.
+    if names is None:
+        return [a['name'] for a in program.get(kind, []) if not a.get('is_direct')]
+    return [findArray(program, kind, name)['name'] for name in names]
+
+class ThreadLocalStdout:
+    """Stands in for sys.stdout, so that the output the runtime CLI prints while
+    running a command can be captured by the thread running it."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buf = StringIO()
+
+    def release(self):
+        buf, self.local.buf = self.local.buf, None
+        return buf.getvalue()
+
+    def write(self, s):
+        buf = getattr(self.local, 'buf', None)
+        if buf is not None: buf.write(s)
+        else: self.stdout.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+class ConfigGate:
+    """The runtime CLI keeps the program it's talking to (tables, actions, ...)
+    in module globals. Sessions for switches running the same program can run
+    commands concurrently; switching to another program waits for them."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.loaded = None
+        self.active = 0
+
+    def enter(self, digest, json_config):
+        with self.cond:
+            while self.loaded != digest and self.active > 0:
+                self.cond.wait()
+            if self.loaded != digest:
+                runtime_CLI.load_json_str(json_config)
+                self.loaded = digest
+            self.active += 1
+
+    def exit(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def invalidate(self):
+        with self.cond:
+            self.loaded = None
+
+_stdout = None
+_stdout_users = 0
+_gate = ConfigGate()
+_setup_lock = threading.Lock()
+
+def captureStdout():
+    """Put a ThreadLocalStdout in place of sys.stdout, until every caller has
+    called releaseStdout(). It is only there while commands are running, so
+    that the rest of the process keeps the real sys.stdout."""
+    global _stdout, _stdout_users
+    with _setup_lock:
+        if _stdout_users == 0:
+            _stdout = ThreadLocalStdout(sys.stdout)
+            sys.stdout = _stdout
+        _stdout_users += 1
+        return _stdout
+
+def releaseStdout():
+    global _stdout, _stdout_users
+    with _setup_lock:
+        _stdout_users -= 1
+        if _stdout_users == 0:
+            # Unless something else has replaced it since.
+            if sys.stdout is _stdout: sys.stdout = _stdout.stdout
+            _stdout = None
+
+class SwitchSession:
+    """A control-plane connection to one switch. Opens the Thrift clients and
+    fetches the switch's JSON once, then runs CLI commands in-process. If the
+    bmv2 Python modules aren't available, each call starts the CLI instead."""
+
+    def __init__(self, thrift_port, cli_path='simple_switch_CLI', thrift_ip='localhost', json_path=None):
+        self.thrift_port = thrift_port
+        self.thrift_ip = thrift_ip
+        self.cli_path = cli_path
+        self.json_path = json_path # only used without the bmv2 modules
+        self.api = None
+        self.standard_client = None
+        self.json_config = None
+        self.digest = None
+
+    def inProcess(self):
+        return runtime_CLI is not None
+
+    def connect(self):
+        if self.api is not None: return
+        pre = runtime_CLI.PreType.SimplePreLAG
+        services = runtime_CLI.RuntimeAPI.get_thrift_services(pre)
+        services.extend(SimpleSwitchAPI.get_thrift_services())
+        try:
+            standard_client, mc_client, sswitch_client = runtime_CLI.thrift_connect(
+                    self.thrift_ip, self.thrift_port, services)
+        except SystemExit:
+            raise Exception("Could not connect to the switch's Thrift server on port %d" % self.thrift_port)
+        self.standard_client = standard_client
+        self.api = SimpleSwitchAPI(pre, standard_client, mc_client, sswitch_client)
+        self.reload()
+
+    def reload(self):
+        "Fetch the switch's program again, e.g. after swap_configs."
+        if not self.inProcess(): return
+        if self.api is None: return self.connect()
+        self.json_config = self.standard_client.bm_get_config()
+        self.digest = hashlib.sha1(self.json_config).hexdigest()
+        _gate.invalidate()
+
+    def run(self, commands):
+        "Run CLI commands. Returns a dict for each: its output and, if any, a handle."
+        if not self.inProcess(): return self.runCli(commands)
+        self.connect()
+
+        stdout = captureStdout()
+        results = []
+        entered = False
+        try:
+            _gate.enter(self.digest, self.json_config)
+            entered = True
+            for command in commands:
+                stdout.capture()
+                error = None
+                try:
+                    self.api.onecmd(command)
+                except Exception as e:
+                    error = '%s: %s' % (type(e).__name__, e)
+                result = parseCliOutput(stdout.release())
+                if error:
+                    result['error'] = error
+                results.append(result)
+                if command.split()[:1] == ['swap_configs'] and 'error' not in result:
+                    # Later commands are for the new program.
+                    self.json_config = self.standard_client.bm_get_config()
+                    self.digest = hashlib.sha1(self.json_config).hexdigest()
+                    _gate.exit()
+                    entered = False
+                    _gate.invalidate()
+                    _gate.enter(self.digest, self.json_config)
+                    entered = True
+        finally:
+            if entered: _gate.exit()
+            releaseStdout()
+        return results
+
+    def runCli(self, commands):
+        p = subprocess.Popen([self.cli_path, '--thrift-port', str(self.thrift_port)],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdout, _ = p.communicate(input='\n'.join(commands))
+        raw_results = stdout.split('RuntimeCmd:')[1:len(commands)+1]
+        return map(parseCliOutput, raw_results)
+
+    def readRegister(self, register, idx):
+        if not self.inProcess():
+            output = self.runCli(['register_read %s %d' % (register, idx)])[0]['raw']
+            line = filter(lambda l: ' %s[%d]' % (register, idx) in l, output.split('\n'))[0]
+            return long(line.split('= ', 1)[1])
+        self.connect()
+        return long(self.standard_client.bm_register_read(0, register, idx))
+
+    def program(self):
+        "The switch's program, as parsed JSON."
+        if not self.inProcess():
+            with open(self.json_path, 'r') as f:
+                return json.load(f)
+        self.connect()
+        return json.loads(self.json_config)
+
+    def readRegisters(self, register):
+        "All of a register array's values."
+        if not self.inProcess():
+            output = self.runCli(['register_read %s' % register])[0]['raw']
+            values = output.split('=', 1)[1].strip()
+            return [long(v) for v in values.split(',')] if values else []
+        self.connect()
+        return map(long, self.standard_client.bm_register_read_all(0, register))
+
+    def readCounters(self, counter, size):
+        "The packet and byte counts of every cell of a counter array."
+        if not self.inProcess():
+            results = self.runCli(['counter_read %s %d' % (counter, i) for i in range(size)])
+            field = lambda name, raw: long(re.search(name + r'=(\d+)', raw).group(1))
+            return ([field('packets', r['raw']) for r in results],
+                    [field('bytes', r['raw']) for r in results])
+        self.connect()
+        values = [self.standard_client.bm_counter_read(0, counter, i) for i in range(size)]
+        return [v.packets for v in values], [v.bytes for v in values]
+
+    def readMeters(self, meter, size):
+        "The configured (rate, burst) pairs of every cell of a meter array."
+        if not self.inProcess():
+            results = self.runCli(['meter_get_rates %s %d' % (meter, i) for i in range(size)])
+            return [[(float(rate), long(burst)) for rate, burst in
+                     re.findall(r'info rate = ([^,]+), burst size = (\d+)', r['raw'])]
+                    for r in results]
+        self.connect()
+        return [[(c.units_per_micros, c.burst_size) for c in self.standard_client.bm_meter_get_rates(0, meter, i)]
+                for i in range(size)]
+
+    def addEntries(self, calls):
+        "Add table entries given as the arguments of bm_mt_add_entry. Returns the errors."
+        self.connect()
+        add = self.standard_client.bm_mt_add_entry
+        errors = []
+        for call in calls:
+            try:
+                add(0, *call)
+            except Exception as e:
+                errors.append('%s: %s' % (type(e).__name__, e))
+        return errors
+
+    def close(self):
+        if self.api is None: return
+        # thrift_connect doesn't hand back the transport; closing the client's
+        # output protocol's transport closes the shared socket.
+        try:
+            self.standard_client._oprot.trans.close()
+        except Exception:
+            pass
+        self.api = None
+        self.standard_client = None
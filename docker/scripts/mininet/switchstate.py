@@ -0,0 +1,348 @@
+from collections import OrderedDict
+
+def hasPriority(match):
+    # The CLI takes a priority after the action parameters exactly when the
+    # table has ternary or range keys, which are written with &&& and ->.
+    return any('&&&' in m or '->' in m for m in match)
+
+def parseTableAdd(tokens):
+    "table_add <table> <action> <match ...> => <params ...> [priority]"
+    table, action = tokens[1], tokens[2]
+    rest = tokens[3:]
+    if '=>' in rest:
+        i = rest.index('=>')
+        match, params = rest[:i], rest[i+1:]
+    else:
+        match, params = rest, []
+    priority = None
+    if hasPriority(match) and params:
+        params, priority = params[:-1], params[-1]
+    return (table, tuple(match)), (action, tuple(params), priority)
+
+class TableState:
+    """The desired state of a switch's tables: its default actions and entries,
+    keyed by table and match, built from a list of CLI commands. The first
+    command for a table or entry wins; later ones for the same key are
+    dropped, with a warning if they disagree. Other commands are kept as
+    they are, duplicates included, and `order` keeps every command's place
+    relative to the table commands."""
+
+    def __init__(self):
+        self.defaults = OrderedDict() # table -> (action, params)
+        self.entries = OrderedDict()  # (table, match) -> (action, params, priority)
+        self.other = []
+        self.order = [] # ('default', table), ('entry', key) or ('other', (command, n))
+        self.warnings = []
+
+    @classmethod
+    def fromCommands(cls, commands):
+        state = cls()
+        for command in commands:
+            state.addCommand(command)
+        return state
+
+    def addCommand(self, command):
+        tokens = command.split()
+        if not tokens: return
+        if tokens[0] == 'table_set_default' and len(tokens) >= 3:
+            if self.addValue(self.defaults, tokens[1], (tokens[2], tuple(tokens[3:])), command):
+                self.order.append(('default', tokens[1]))
+        elif tokens[0] == 'table_add' and len(tokens) >= 3:
+            key, value = parseTableAdd(tokens)
+            if self.addValue(self.entries, key, value, command):
+                self.order.append(('entry', key))
+        else:
+            if tokens[0] == 'table_clear' and len(tokens) > 1:
+                # The entries added before it won't be in the table.
+                cleared = [key for key in self.entries if key[0] == tokens[1]]
+                for key in cleared:
+                    del self.entries[key]
+                self.order = [item for item in self.order if item[0] != 'entry' or item[1] not in cleared]
+            # The n-th copy of a command is a command of its own, e.g. a second
+            # mc_node_create that makes a second node.
+            self.order.append(('other', (command, self.other.count(command))))
+            self.other.append(command)
+
+    def addValue(self, values, key, value, command):
+        if key not in values:
+            values[key] = value
+            return True
+        if values[key] != value:
+            self.warnings.append('Ignoring conflicting command: %s' % command)
+        return False
+
+# What a successful command prints, before anything it prints on an error.
+CLI_SUCCESS = {'default': 'Setting default action',
+               'delete': 'Deleting entry',
+               'modify': 'Modifying entry'}
+
+class InstalledTables:
+    """What has been installed on a switch, with the entries' handles. plan()
+    returns the commands that bring it to a desired TableState, and apply()
+    records their results."""
+
+    def __init__(self):
+        self.defaults = {}
+        self.entries = {} # (table, match) -> (handle, value)
+        self.other = set() # (command, n)
+
+    def plan(self, desired):
+        ops = []
+        # Delete first, so that entries that are replaced don't collide.
+        for key in self.entries:
+            if key not in desired.entries:
+                ops.append(('delete', key, None))
+        # Then follow the commands' order, so that e.g. a table_clear still
+        # comes before or after the entries it did.
+        for kind, key in desired.order:
+            if kind == 'default':
+                value = desired.defaults[key]
+                if self.defaults.get(key) != value:
+                    ops.append(('default', key, value))
+            elif kind == 'other':
+                if key not in self.other:
+                    ops.append(('other', key, None))
+            else:
+                value = desired.entries[key]
+                if key not in self.entries:
+                    ops.append(('add', key, value))
+                elif self.entries[key][1] != value:
+                    old = self.entries[key][1]
+                    if old[2] != value[2]: # the priority can't be modified in place
+                        ops.append(('delete', key, None))
+                        ops.append(('add', key, value))
+                    else:
+                        ops.append(('modify', key, value))
+        return ops
+
+    def command(self, op):
+        kind, key, value = op
+        if kind == 'default':
+            action, params = value
+            return ' '.join(['table_set_default', key, action] + list(params))
+        if kind == 'other':
+            return key[0]
+        table, match = key
+        if kind == 'delete':
+            return 'table_delete %s %d' % (table, self.entries[key][0])
+        action, params, priority = value
+        if kind == 'modify':
+            return ' '.join(['table_modify', table, action, str(self.entries[key][0])] + list(params))
+        tokens = ['table_add', table, action] + list(match) + ['=>'] + list(params)
+        if priority is not None: tokens.append(priority)
+        return ' '.join(tokens)
+
+    def apply(self, op, result):
+        "Record an op's result. Only a command that clearly worked changes the state."
+        kind, key, value = op
+        if 'error' in result: return
+        if kind in CLI_SUCCESS and CLI_SUCCESS[kind] not in result['raw']: return
+        if kind == 'default':
+            self.defaults[key] = value
+        elif kind == 'other':
+            self.other.add(key)
+            tokens = key[0].split()
+            if tokens[0] == 'table_clear' and len(tokens) > 1:
+                # The entries installed so far are gone.
+                for entry in [k for k in self.entries if k[0] == tokens[1]]:
+                    del self.entries[entry]
+        elif kind == 'delete':
+            del self.entries[key]
+        elif kind == 'modify':
+            self.entries[key] = (self.entries[key][0], value)
+        elif kind == 'add' and 'handle' in result:
+            self.entries[key] = (result['handle'], value)
+
+def planMcastGroups(desired, installed):
+    """Compare desired multicast groups (mgid -> ports) with installed ones
+    (mgid -> (node handle, ports)). Returns the groups to create, update and
+    destroy."""
+    create, update, destroy = [], [], []
+    for mgid, ports in desired.iteritems():
+        if mgid not in installed:
+            create.append(mgid)
+        elif sorted(installed[mgid][1]) != sorted(ports):
+            update.append(mgid)
+    for mgid in installed:
+        if mgid not in desired:
+            destroy.append(mgid)
+    return sorted(create), sorted(update), sorted(destroy)
+
+class InstalledSelector:
+    """The members, groups and entries installed in a table that has an action
+    selector. sync() brings them to a desired state, given as a default member
+    and a map from match to the list of members, (action, params), to spread
+    matching packets over. `send` runs a list of CLI commands and returns
+    their results. sync() returns the errors; routes whose members or group
+    could not be created are left as they were."""
+
+    def __init__(self, table):
+        self.table = table
+        self.members = {} # (action, params) -> handle
+        self.groups = {}  # tuple of members -> handle
+        self.entries = {} # match -> (handle, tuple of members)
+        self.default = None
+
+    def sync(self, default, routes, send):
+        routes = dict((match, tuple(sorted(set(members)))) for match, members in routes.iteritems())
+        errors = []
+
+        # Members and groups first, since the entries refer to them by handle.
+        wanted = set(m for members in routes.values() for m in members)
+        if default is not None: wanted.add(default)
+        new_members = sorted(wanted - set(self.members))
+        results = send(['table_indirect_create_member %s %s' % (self.table, ' '.join((action,) + params))
+                        for action, params in new_members])
+        for member, result in zip(new_members, results):
+            if 'handle' in result and 'error' not in result:
+                self.members[member] = result['handle']
+            else:
+                errors.append('Could not create member %s of %s: %s' % (
+                        ' '.join((member[0],) + member[1]), self.table,
+                        result.get('error', result['raw'].strip())))
+
+        new_groups = sorted(set(m for m in routes.values() if len(m) > 1
+                                and all(x in self.members for x in m)) - set(self.groups))
+        results = send(['table_indirect_create_group %s' % self.table for _ in new_groups])
+        commands = []
+        for group, result in zip(new_groups, results):
+            if 'handle' not in result or 'error' in result:
+                errors.append('Could not create a group in %s: %s' % (
+                        self.table, result.get('error', result['raw'].strip())))
+                continue
+            self.groups[group] = result['handle']
+            commands += ['table_indirect_add_member_to_group %s %d %d' %
+                         (self.table, self.members[m], result['handle']) for m in group]
+        send(commands)
+
+        def installable(members):
+            if len(members) == 1: return members[0] in self.members
+            return members in self.groups
+        skipped = set(match for match, members in routes.iteritems() if not installable(members))
+        for match in sorted(skipped):
+            errors.append('Not updating %s %s: its members or group could not be created' % (self.table, match))
+
+        # Entries whose members changed are deleted and added again.
+        commands, ops = [], []
+        if default is not None and default != self.default:
+            if default in self.members:
+                commands.append('table_indirect_set_default %s %d' % (self.table, self.members[default]))
+                ops.append(('default', default))
+        for match, (handle, members) in self.entries.items():
+            if match in skipped: continue
+            if routes.get(match) != members:
+                commands.append('table_indirect_delete %s %d' % (self.table, handle))
+                ops.append(('delete', match))
+        for match, members in sorted(routes.iteritems()):
+            if match in skipped: continue
+            if match in self.entries and self.entries[match][1] == members: continue
+            if len(members) == 1:
+                commands.append('table_indirect_add %s %s => %d' % (self.table, match, self.members[members[0]]))
+            else:
+                commands.append('table_indirect_add_with_group %s %s => %d' % (self.table, match, self.groups[members]))
+            ops.append(('add', (match, members)))
+        for (kind, value), result in zip(ops, send(commands)):
+            if 'error' in result:
+                errors.append('%s %s: %s' % (self.table, kind, result['error']))
+                continue
+            if kind == 'default':
+                self.default = value
+            elif kind == 'delete':
+                del self.entries[value]
+            elif 'handle' in result:
+                self.entries[value[0]] = (result['handle'], value[1])
+
+        # Clean up the groups and members nothing refers to any more.
+        used_groups = set(members for _, members in self.entries.values() if len(members) > 1)
+        stale_groups = [g for g in self.groups if g not in used_groups]
+        send(['table_indirect_delete_group %s %d' % (self.table, self.groups[g]) for g in stale_groups])
+        for g in stale_groups: del self.groups[g]
+
+        used_members = set(m for _, members in self.entries.values() for m in members)
+        if self.default is not None: used_members.add(self.default)
+        stale_members = [m for m in self.members if m not in used_members]
+        send(['table_indirect_delete_member %s %d' % (self.table, self.members[m]) for m in stale_members])
+        for m in stale_members: del self.members[m]
+        return errors
+
+if __name__ == '__main__':
+    import itertools
+    from switchsession import parseCliOutput
+
+    handles = itertools.count(1)
+
+    def output(command, reject):
+        # What a switch would print for `command`, or an error if it starts
+        # with one of `reject`.
+        if any(command.startswith(r) for r in reject): return 'Error: rejected\n'
+        if 'create' in command: return 'Member has been created with handle %d\n' % handles.next()
+        if command.split()[0] in ['table_add', 'table_indirect_add', 'table_indirect_add_with_group']:
+            return 'Entry has been added with handle %d\n' % handles.next()
+        if command.startswith('table_set_default'): return 'Setting default action of table\n'
+        if command.startswith('table_modify'): return 'Modifying entry\n'
+        if command.startswith('table_delete'): return 'Deleting entry\n'
+        return ''
+
+    def sync(installed, commands, reject=()):
+        sent = []
+        for op in installed.plan(TableState.fromCommands(commands)):
+            command = installed.command(op)
+            sent.append(command)
+            installed.apply(op, parseCliOutput(output(command, reject)))
+        return sent
+
+    # Duplicates are dropped, and the first of conflicting commands wins.
+    state = TableState.fromCommands(['table_add fwd set_port 1 => 2',
+                                     'table_add fwd set_port 1 => 2',
+                                     'table_add fwd set_port 1 => 3',
+                                     'table_set_default fwd _drop',
+                                     'table_set_default fwd set_port 4',
+                                     'register_write r 0 1',
+                                     'register_write r 0 1'])
+    assert state.entries == {('fwd', ('1',)): ('set_port', ('2',), None)}
+    assert state.defaults == {'fwd': ('_drop', ())}
+    assert len(state.warnings) == 2
+    assert state.order == [('entry', ('fwd', ('1',))), ('default', 'fwd'),
+                           ('other', ('register_write r 0 1', 0)), ('other', ('register_write r 0 1', 1))]
+
+    # An entry is modified in place, unless its priority changed.
+    installed = InstalledTables()
+    sync(installed, ['table_add fwd set_port 1 => 2', 'table_add acl allow 0x1&&&0xff => 10'])
+    acl_handle = installed.entries[('acl', ('0x1&&&0xff',))][0]
+    assert sync(installed, ['table_add fwd set_port 1 => 3', 'table_add acl allow 0x1&&&0xff => 20']) == \
+            ['table_modify fwd set_port %d 3' % installed.entries[('fwd', ('1',))][0],
+             'table_delete acl %d' % acl_handle,
+             'table_add acl allow 0x1&&&0xff => 20']
+    assert installed.entries[('acl', ('0x1&&&0xff',))][1] == ('allow', (), '20')
+    assert sync(installed, ['table_add fwd set_port 1 => 3', 'table_add acl allow 0x1&&&0xff => 20']) == []
+
+    # A table_clear drops the entries before it, and keeps its place.
+    state = TableState.fromCommands(['table_add fwd set_port 1 => 2', 'table_clear fwd',
+                                     'table_add fwd set_port 2 => 3'])
+    assert state.entries.keys() == [('fwd', ('2',))]
+    installed = InstalledTables()
+    assert sync(installed, ['table_add fwd set_port 1 => 2', 'table_clear fwd',
+                            'table_add fwd set_port 2 => 3']) == ['table_clear fwd', 'table_add fwd set_port 2 => 3']
+    assert installed.entries.keys() == [('fwd', ('2',))]
+
+    # A command the switch rejects isn't recorded, so it is sent again.
+    installed = InstalledTables()
+    commands = ['table_set_default fwd _drop', 'table_add fwd set_port 1 => 2', 'register_write r 0 1']
+    sync(installed, commands, reject=('table_add', 'register_write'))
+    assert installed.defaults == {'fwd': ('_drop', ())}
+    assert installed.entries == {} and installed.other == set()
+    assert sync(installed, commands) == ['table_add fwd set_port 1 => 2', 'register_write r 0 1']
+    assert sync(installed, commands) == []
+
+    # A route is skipped when one of its members couldn't be created.
+    selector = InstalledSelector('ipv4_lpm')
+    routes = {'10.0.1.1/32': [('set_nhop', ('10.0.1.1', '1'))],
+              '10.0.2.2/32': [('set_nhop', ('10.0.2.2', '2')), ('set_nhop', ('10.0.2.3', '3'))]}
+    def send(reject):
+        return lambda commands: [parseCliOutput(output(c, reject)) for c in commands]
+    errors = selector.sync(('_drop', ()), routes,
+                           send(['table_indirect_create_member ipv4_lpm set_nhop 10.0.2.3']))
+    assert len(errors) == 2
+    assert selector.entries.keys() == ['10.0.1.1/32'] and selector.groups == {}
+    assert selector.sync(('_drop', ()), routes, send([])) == []
+    assert sorted(selector.entries) == ['10.0.1.1/32', '10.0.2.2/32'] and len(selector.groups) == 1
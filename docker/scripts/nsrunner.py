@@ -0,0 +1,170 @@
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs commands concurrently, each in its own network namespace, so that
+# several Mininet topologies can share one container without their interfaces
+# or Thrift servers colliding.
+
+import os
+import signal
+import subprocess
+import threading
+import time
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+# A fresh network namespace only has a loopback interface, and it starts out
+# down. The switches' Thrift servers listen on localhost, so bring it up.
+NETNS_WRAPPER = 'ip link set lo up && exec "$@"'
+
+# How long a job that timed out gets to clean up after SIGTERM.
+KILL_GRACE_PERIOD = 5
+
+def netns_of(pid):
+    try:
+        return os.readlink('/proc/%d/ns/net' % pid)
+    except OSError:
+        return None
+
+def list_processes():
+    # pid -> parent pid, for every process that hasn't exited. Zombies are left
+    # out: nothing may be around to reap them.
+    processes = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open('/proc/%s/stat' % entry, 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue # it exited
+        if fields[0] != 'Z':
+            processes[int(entry)] = int(fields[1])
+    return processes
+
+def job_processes(pid, netns):
+    """Everything a job started: the descendants of its first process, and
+    every process in its network namespace. Mininet starts each node with
+    setsid, so a process group doesn't cover them."""
+    processes = list_processes()
+    found = set([pid]) if pid in processes else set()
+    changed = True
+    while changed:
+        children = set(p for p, ppid in processes.items() if ppid in found) - found
+        changed = bool(children)
+        found |= children
+    if netns is not None:
+        found |= set(p for p in processes if netns_of(p) == netns)
+    found.discard(os.getpid())
+    return found
+
+def signal_all(pids, sig):
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass # already gone
+
+def terminate(pid, netns, poll):
+    """SIGTERM the job whose first process is `pid` and everything it started,
+    then SIGKILL whatever is left after KILL_GRACE_PERIOD. `poll` is called while waiting,
+    to reap `pid` once it exits."""
+    pids = job_processes(pid, netns)
+    signal_all(pids, signal.SIGTERM)
+    deadline = time.time() + KILL_GRACE_PERIOD
+    while time.time() < deadline:
+        poll()
+        # Processes whose parents have exited are no longer descendants of
+        # the job, so keep track of the ones found at first too.
+        pids = (pids & set(list_processes())) | job_processes(pid, netns)
+        if not pids: return
+        time.sleep(0.1)
+    signal_all(pids, signal.SIGKILL)
+
+def namespace_command(argv):
+    unshare = find_executable('unshare')
+    if unshare is None:
+        raise Exception("Can't find `unshare`; it is needed to run commands in separate network namespaces")
+    return [unshare, '--net', '--', 'sh', '-c', NETNS_WRAPPER, 'p4app-netns'] + list(argv)
+
+class IsolatedJob:
+
+    def __init__(self, name, argv, cwd=None, log_file=None, timeout=None):
+        self.name = name
+        self.argv = argv
+        self.cwd = cwd
+        self.log_file = log_file
+        self.timeout = timeout
+        self.timed_out = False
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+
+    def duration(self):
+        if self.start_time is None or self.end_time is None: return None
+        return self.end_time - self.start_time
+
+    def run(self):
+        out = open(self.log_file, 'w') if self.log_file else None
+        try:
+            self.start_time = time.time()
+            with open(os.devnull, 'r') as devnull:
+                # Each job gets its own process group, so that everything it
+                # started can be killed if it times out.
+                p = subprocess.Popen(namespace_command(self.argv), cwd=self.cwd,
+                                     stdin=devnull, stdout=out, stderr=subprocess.STDOUT,
+                                     preexec_fn=os.setpgrp)
+                self.returncode = self.wait(p)
+        finally:
+            self.end_time = time.time()
+            if out: out.close()
+        return self
+
+    def wait(self, p):
+        if self.timeout is None: return p.wait()
+        deadline = self.start_time + self.timeout
+        while p.poll() is None:
+            if time.time() > deadline:
+                self.timed_out = True
+                self.kill(p)
+                break
+            time.sleep(0.1)
+        return p.wait()
+
+    def kill(self, p):
+        # Only look for the job's namespace if unshare has created it yet.
+        netns = netns_of(p.pid)
+        if netns == netns_of(os.getpid()): netns = None
+        terminate(p.pid, netns, p.poll)
+
+    def summary(self):
+        return dict(name=self.name, returncode=self.returncode, timed_out=self.timed_out,
+                    seconds=self.duration(), log=self.log_file)
+
+def run_isolated(jobs, max_parallel, on_done=None):
+    # Run `jobs` with at most `max_parallel` of them at once. `on_done` is
+    # called with each job as soon as it finishes.
+    lock = threading.Lock()
+
+    def run_one(job):
+        job.run()
+        if on_done:
+            with lock: on_done(job)
+        return job
+
+    pool = ThreadPool(max(1, min(max_parallel, len(jobs))))
+    try:
+        return pool.map(run_one, jobs)
+    finally:
+        pool.close()
+        pool.join()
@@ -17,11 +17,27 @@ from __future__ import print_function
 
 import argparse
 from collections import OrderedDict
+import hashlib
 import json
+import multiprocessing
 import os
+import pipes
+import runpy
+import shlex
+import shutil
+import subprocess
 import sys
 import tarfile
 
+from compile_cache import CompileCache, compile_key
+from nsrunner import IsolatedJob, run_isolated
+
+# The backends live next to this script. They're imported lazily, by the
+# functions that run them, so that compiling doesn't pay for importing Mininet.
+sys.path.insert(1, os.path.join(sys.path[0], 'mininet'))
+sys.path.insert(2, os.path.join(sys.path[0], 'stf'))
+from apptimings import AppTimings
+
 parser = argparse.ArgumentParser(description='p4apprunner')
 parser.add_argument('--build-dir', help='Directory to build in.',
                     type=str, action='store', required=False, default='/tmp')
@@ -33,12 +49,45 @@ parser.add_argument('--json', help='Use this compiled JSON file instead of compi
                     type=str, action='store', required=False, default=None)
 parser.add_argument('--manifest', help='Path to manifest file.',
                     type=str, action='store', required=False, default='./p4app.json')
-parser.add_argument('app', help='.p4app package to run.', type=str)
+parser.add_argument('--log-dir', help='Directory to save logs and results to.',
+                    type=str, action='store', required=False, default='/tmp/p4app_logs')
+parser.add_argument('--thrift-port', help='First Thrift port to give to switches.',
+                    type=int, action='store', required=False, default=9090)
+parser.add_argument('--ipc-dir', help='Directory for the switches\' nanomsg IPC sockets.',
+                    type=str, action='store', required=False, default='/tmp')
+parser.add_argument('--all-targets', help='Run every target in the package.',
+                    action='store_true', required=False, default=False)
+parser.add_argument('--targets', help='Comma-separated list of targets to run.',
+                    type=str, action='store', required=False, default=None)
+parser.add_argument('--jobs', help='Maximum number of targets to run at once.',
+                    type=int, action='store', required=False,
+                    default=multiprocessing.cpu_count())
+parser.add_argument('--watch', help=('Recompile the program when the package changes, and '
+                                     'swap it into the running switches (mininet and '
+                                     'multiswitch only).'),
+                    action='store_true', required=False, default=False)
+parser.add_argument('--watch-dir', help=('Directory to watch in --watch mode. Changes are '
+                                         'copied into the build directory. Defaults to '
+                                         'the package, if it is a directory.'),
+                    type=str, action='store', required=False, default=None)
+parser.add_argument('--skip-extract', help=argparse.SUPPRESS,
+                    action='store_true', required=False, default=False)
+parser.add_argument('--no-log-link', help=argparse.SUPPRESS,
+                    action='store_true', required=False, default=False)
+parser.add_argument('--compile-cache-dir', help=('Directory to cache compiled programs in. '
+                                                 'Defaults to .compile_cache in the log dir.'),
+                    type=str, action='store', required=False, default=None)
+parser.add_argument('--compile-cache-size', help='Maximum size of the compile cache, in MB.',
+                    type=int, action='store', required=False, default=256)
+parser.add_argument('--no-compile-cache', help='Always run the compiler.',
+                    action='store_true', required=False, default=False)
+parser.add_argument('app', help='.p4app package to run: a directory or an archive.', type=str)
 parser.add_argument('target', help=('Target to run. Defaults to the first target '
                                     'in the package.'),
                     nargs='?', type=str)
 
-args = parser.parse_args()
+args = None
+timings = None
 
 def log(*items):
     if args.quiet != True:
@@ -51,6 +100,16 @@ def run_command(command):
     log('>', command)
     return os.WEXITSTATUS(os.system(command))
 
+def run_program(argv):
+    # Like run_command, but without going through the shell.
+    log('>', ' '.join(argv))
+    return subprocess.call(argv)
+
+# Each target run by --all-targets/--targets gets a view of the package in this
+# subdirectory of the build directory, and a block of Thrift ports this big.
+TARGETS_DIR = '.p4app_targets'
+THRIFT_PORT_STRIDE = 100
+
 class Manifest:
     def __init__(self, program_file, language, target, target_config):
         self.program_file = program_file
@@ -58,23 +117,26 @@ class Manifest:
         self.target = target
         self.target_config = target_config
 
-def read_manifest(manifest_file):
+def load_manifest(manifest_file):
     manifest = json.load(manifest_file, object_pairs_hook=OrderedDict)
 
     if 'program' not in manifest:
         log_error('No program defined in manifest.')
         sys.exit(1)
-    program_file = manifest['program']
 
     if 'language' not in manifest:
         log_error('No language defined in manifest.')
         sys.exit(1)
-    language = manifest['language']
 
     if 'targets' not in manifest or len(manifest['targets']) < 1:
         log_error('No targets defined in manifest.')
         sys.exit(1)
 
+    return manifest
+
+def read_manifest(manifest_file):
+    manifest = load_manifest(manifest_file)
+
     if args.target is not None:
         chosen_target = args.target
     elif 'default-target' in manifest:
@@ -86,7 +148,8 @@ def read_manifest(manifest_file):
         log_error('Target not found in manifest:', chosen_target)
         sys.exit(1)
 
-    return Manifest(program_file, language, chosen_target, manifest['targets'][chosen_target])
+    return Manifest(manifest['program'], manifest['language'], chosen_target,
+                    manifest['targets'][chosen_target])
 
 def get_program_name(program_file):
     return os.path.basename(program_file).rstrip('.p4')
@@ -103,9 +166,9 @@ def run_compile_bmv2(manifest):
     compiler_args = []
 
     if manifest.language == 'p4-14':
-        compiler_args.append('--p4v 14')
+        compiler_args.extend(['--p4v', '14'])
     elif manifest.language == 'p4-16':
-        compiler_args.append('--p4v 16')
+        compiler_args.extend(['--p4v', '16'])
     else:
         log_error('Unknown language:', manifest.language)
         sys.exit(1)
@@ -115,13 +178,30 @@ def run_compile_bmv2(manifest):
         if not isinstance(flags, list):
             log_error('compiler-flags should be a list:', flags)
             sys.exit(1)
-        compiler_args.extend(flags)
+        for flag in flags:
+            compiler_args.extend(shlex.split(flag))
 
-    # Compile the program.
+    # Compile the program, unless an identical compilation is already cached.
+    compiler = 'p4c-bm2-ss'
     output_file = get_program_name(manifest.program_file) + '.json'
-    compiler_args.append('"%s"' % manifest.program_file)
-    compiler_args.append('-o "%s"' % output_file)
-    rv = run_command('p4c-bm2-ss %s' % ' '.join(compiler_args))
+
+    cache, cache_key = None, None
+    if not args.no_compile_cache and os.path.isfile(manifest.program_file):
+        cache_dir = args.compile_cache_dir or os.path.join(args.log_dir, '.compile_cache')
+        cache = CompileCache(cache_dir, args.compile_cache_size * 1024 * 1024)
+        cache_key = cache.key(manifest.program_file, manifest.language,
+                              compiler_args, compiler)
+
+    with timings.phase('compile'):
+        if cache and cache.lookup(cache_key, output_file):
+            log('Using cached compilation of', manifest.program_file)
+            rv = 0
+        else:
+            compiler_args += [manifest.program_file, '-o', output_file]
+            rv = run_program([compiler] + compiler_args)
+            if cache and rv == 0:
+                cache.store(cache_key, output_file)
+    timings.save()
 
     if 'run-after-compile' in manifest.target_config:
         commands = manifest.target_config['run-after-compile']
@@ -137,17 +217,81 @@ def run_compile_bmv2(manifest):
 
     return output_file
 
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def sync_tree(src_dir, dst_dir):
+    # Copy the files under src_dir that are missing or different in dst_dir.
+    # Returns the relative paths of the files that were copied.
+    copied = []
+    for d, _, files in os.walk(src_dir):
+        rel_dir = os.path.relpath(d, src_dir)
+        out_dir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+        if not os.path.isdir(out_dir): os.makedirs(out_dir)
+        for name in files:
+            src, dst = os.path.join(d, name), os.path.join(out_dir, name)
+            if os.path.isfile(dst) and os.path.getsize(src) == os.path.getsize(dst) \
+                    and file_digest(src) == file_digest(dst):
+                continue
+            shutil.copy2(src, dst)
+            copied.append(os.path.normpath(os.path.join(rel_dir, name)))
+    return copied
+
+def program_key(manifest):
+    flags = manifest.target_config.get('compiler-flags', [])
+    return compile_key(manifest.program_file, manifest.language, flags, 'p4c-bm2-ss')
+
+def make_recompiler(manifest):
+    # Returns a function for --watch mode that brings the build directory up to
+    # date with the watched directory and, if the program's sources changed,
+    # recompiles it and returns the path of the new JSON file.
+    state = dict(key=program_key(manifest))
+
+    def recompile():
+        if watch_dir() != os.getcwd():
+            for path in sync_tree(watch_dir(), os.getcwd()):
+                log('Updated', path)
+        key = program_key(manifest)
+        if key == state['key']: return None
+        state['key'] = key
+
+        log('Program changed; recompiling.')
+        try:
+            return os.path.abspath(run_compile_bmv2(manifest))
+        except SystemExit:
+            log_error('Keeping the program that is currently running.')
+            return None
+
+    return recompile
+
+def watch_dir():
+    if args.watch_dir: return os.path.abspath(args.watch_dir)
+    if os.path.isdir(args.app): return os.path.abspath(args.app)
+    return os.getcwd()
+
+def watch_args(manifest):
+    # Extra arguments for the backends' main() in --watch mode.
+    if not args.watch: return {}
+    return dict(watch_dir=watch_dir(), recompile=make_recompiler(manifest))
+
+def compile_program(manifest):
+    # Use the JSON file we were given, if any; otherwise, compile the program.
+    if args.json: return os.path.abspath(args.json)
+    return run_compile_bmv2(manifest)
+
 def run_mininet(manifest):
-    output_file = run_compile_bmv2(manifest)
+    output_file = compile_program(manifest)
 
     # Run the program using the BMV2 Mininet simple switch.
     switch_args = []
 
-    # We'll place the switch's log file in '/var/log'. The Dockerfile places a
-    # volume at this path. This works around the fact that Ubuntu 14.04 includes
-    # a version of 'tail' which doesn't interact well with overlayfs.
-    log_file = os.path.join('/var/log', manifest.program_file + '.log')
-    switch_args.append('--log-file "%s"' % log_file)
+    # The switch's log goes in the target's own log directory, so that targets
+    # running concurrently don't share it. The log directory is a volume,
+    # which also works around the fact that Ubuntu 14.04 includes a version of
+    # 'tail' which doesn't interact well with overlayfs.
+    log_file = os.path.join(args.log_dir, 'p4s.s1.log')
+    switch_args += ['--log-file', log_file]
 
     # Generate a message that will be printed by the Mininet CLI to make
     # interacting with the simple switch a little easier.
@@ -176,22 +320,38 @@ def run_mininet(manifest):
         print('  docker exec -t -i %s bm_p4dbg' % container, file=message)
         print(file=message)
 
-    switch_args.append('--cli-message "%s"' % message_file)
+    switch_args += ['--cli-message', message_file]
 
     if 'pcap_dump' in manifest.target_config and manifest.target_config['pcap_dump']:
         switch_args.append('--pcap-dump')
 
     if 'num-hosts' in manifest.target_config:
-        switch_args.append('--num-hosts %s' % manifest.target_config['num-hosts'])
+        switch_args += ['--num-hosts', str(manifest.target_config['num-hosts'])]
 
     if 'switch-config' in manifest.target_config:
-        switch_args.append('--switch-config "%s"' % manifest.target_config['switch-config'])
-
-    switch_args.append('--behavioral-exe "%s"' % 'simple_switch')
-    switch_args.append('--json "%s"' % output_file)
-
-    program = '"%s/mininet/single_switch_mininet.py"' % sys.path[0]
-    return run_command('python2 %s %s' % (program, ' '.join(switch_args)))
+        switch_args += ['--switch-config', manifest.target_config['switch-config']]
+
+    config = manifest.target_config
+    if 'profile' in config:
+        switch_args += ['--profile', config['profile']]
+    if 'log_level' in config:
+        switch_args += ['--log-level', config['log_level']]
+    for key in ['switch_args', 'target_args']:
+        if key in config:
+            value = config[key]
+            if not isinstance(value, basestring):
+                value = ' '.join(pipes.quote(str(a)) for a in value)
+            switch_args += ['--' + key.replace('_', '-'), value]
+
+    switch_args += ['--behavioral-exe', config.get('behavioral_exe', 'simple_switch')]
+    switch_args += ['--json', output_file]
+    switch_args += ['--thrift-port', str(args.thrift_port)]
+    switch_args += ['--ipc-dir', args.ipc_dir]
+    switch_args += ['--log-dir', args.log_dir]
+
+    import single_switch_mininet
+    return single_switch_mininet.main(single_switch_mininet.parser.parse_args(switch_args),
+                                      **watch_args(manifest))
 
 def build_only(manifest):
 
@@ -200,15 +360,15 @@ def build_only(manifest):
         model = manifest.target_config['model']
 
     if model == 'bmv2':
-        output_file = run_compile_bmv2(manifest)
+        output_file = compile_program(manifest)
     else:
         log_error('Unrecognized model:', model)
         sys.exit(1)
 
-    rc = run_command('cp %s /tmp/p4app_logs/program.json' % output_file)
-
-    if rc != 0:
-        log_error("Failed to copy compiled program to output location")
+    try:
+        shutil.copyfile(output_file, os.path.join(args.log_dir, 'program.json'))
+    except IOError as e:
+        log_error("Failed to copy compiled program to output location:", e)
         sys.exit(1)
 
 def run_multiswitch(manifest):
@@ -218,8 +378,7 @@ def run_multiswitch(manifest):
         model = manifest.target_config['model'].lower()
 
     if model == 'bmv2':
-        if args.json: json_file = os.path.abspath(args.json)
-        else:         json_file = run_compile_bmv2(manifest)
+        json_file = compile_program(manifest)
         behavioral_exe = 'simple_switch'
         switch_cli = 'simple_switch_CLI'
     else:
@@ -227,20 +386,52 @@ def run_multiswitch(manifest):
         sys.exit(1)
 
     script_args = []
-    script_args.append('--log-dir "/tmp/p4app_logs"')
-    script_args.append('--manifest "%s"' % args.manifest)
-    script_args.append('--target "%s"' % manifest.target)
+    script_args += ['--log-dir', args.log_dir]
+    script_args += ['--manifest', args.manifest]
+    script_args += ['--target', manifest.target]
     if 'auto-control-plane' in manifest.target_config and manifest.target_config['auto-control-plane']:
         script_args.append('--auto-control-plane' )
-    script_args.append('--behavioral-exe "%s"' % behavioral_exe)
-    script_args.append('--cli-path "%s"' % switch_cli)
-    script_args.append('--json "%s"' % json_file)
+    script_args += ['--behavioral-exe', behavioral_exe]
+    script_args += ['--cli-path', switch_cli]
+    script_args += ['--json', json_file]
+    script_args += ['--thrift-port', str(args.thrift_port)]
+    script_args += ['--ipc-dir', args.ipc_dir]
+
+    import multi_switch_mininet
+    return multi_switch_mininet.main(multi_switch_mininet.parser.parse_args(script_args),
+                                     **watch_args(manifest))
+
+def run_cp_bench(manifest):
+    json_file = compile_program(manifest)
+    config = manifest.target_config
 
-    program = '"%s/mininet/multi_switch_mininet.py"' % sys.path[0]
-    return run_command('python2 %s %s' % (program, ' '.join(script_args)))
+    def as_list(value):
+        return ','.join(str(v) for v in (value if isinstance(value, list) else [value]))
+
+    script_args = []
+    script_args += ['--behavioral-exe', 'simple_switch']
+    script_args += ['--cli-path', 'simple_switch_CLI']
+    script_args += ['--json', json_file]
+    script_args += ['--thrift-port', str(args.thrift_port)]
+    script_args += ['--log-dir', args.log_dir]
+    if 'tables' in config:
+        script_args += ['--tables', as_list(config['tables'])]
+    if 'entries' in config:
+        script_args += ['--entries', as_list(config['entries'])]
+    if 'paths' in config:
+        script_args += ['--paths', as_list(config['paths'])]
+    if 'batch' in config:
+        script_args += ['--batch', str(config['batch'])]
+    if 'baseline' in config:
+        script_args += ['--baseline', config['baseline']]
+    if 'tolerance' in config:
+        script_args += ['--tolerance', str(config['tolerance'])]
+
+    import cp_bench
+    return cp_bench.main(cp_bench.parser.parse_args(script_args))
 
 def run_stf(manifest):
-    output_file = run_compile_bmv2(manifest)
+    output_file = compile_program(manifest)
 
     if not 'test' in manifest.target_config:
         log_error('No STF test file provided.')
@@ -248,71 +439,242 @@ def run_stf(manifest):
     stf_file = manifest.target_config['test']
 
     # Run the program using the BMV2 STF interpreter.
-    stf_args = []
+    stf_args = ['bmv2stf.py']
     stf_args.append('-v')
     stf_args.append(os.path.join(args.build_dir, output_file))
     stf_args.append(os.path.join(args.build_dir, stf_file))
 
-    program = '"%s/stf/bmv2stf.py"' % sys.path[0]
-    rv = run_command('python2 %s %s' % (program, ' '.join(stf_args)))
+    import bmv2stf
+    rv = bmv2stf.main(stf_args)
     if rv != 0:
         sys.exit(1)
     return rv
 
 def run_custom(manifest):
-    output_file = run_compile_bmv2(manifest)
-    python_path = 'PYTHONPATH=$PYTHONPATH:/scripts/mininet/'
+    output_file = compile_program(manifest)
     script_args = []
-    script_args.append('--behavioral-exe "%s"' % 'simple_switch')
-    script_args.append('--json "%s"' % output_file)
-    script_args.append('--cli "%s"' % 'simple_switch_CLI')
+    script_args += ['--behavioral-exe', 'simple_switch']
+    script_args += ['--json', output_file]
+    script_args += ['--cli', 'simple_switch_CLI']
     if not 'program' in manifest.target_config:
          log_error('No mininet program file provided.')
          sys.exit(1)
-    program = manifest.target_config['program']
-    rv = run_command('%s python2 %s %s' % (python_path, program, ' '.join(script_args)))
+    program = shlex.split(manifest.target_config['program'])
+
+    # Run the program as if it had been started as a script, with the Mininet
+    # helper modules (already on our path) importable.
+    log('>', ' '.join(program + script_args))
+    sys.argv = program + script_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(program[0])))
+    try:
+        runpy.run_path(program[0], run_name='__main__')
+        rv = 0
+    except SystemExit as e:
+        if e.code is None:
+            rv = 0
+        elif isinstance(e.code, int):
+            rv = e.code
+        else:
+            log_error(e.code)
+            rv = 1
 
     if rv != 0:
         sys.exit(1)
     return rv
 
-def main():
-    log('Entering build directory.')
-    os.chdir(args.build_dir)
+def get_backend(manifest):
+    if 'use' in manifest.target_config:
+        return manifest.target_config['use']
+    return manifest.target
+
+def extract_package():
+    # A '.p4app' package is either a directory or a '.tar.gz' archive of one.
+    # Bring the build directory up to date with its contents. Returns the
+    # top-level entries of the package.
+    if os.path.isdir(args.app):
+        log('Syncing package.')
+        sync_tree(args.app, os.getcwd())
+        return sorted(os.listdir(args.app))
 
-    # A '.p4app' package is really just a '.tar.gz' archive. Extract it so we
-    # can process its contents.
     log('Extracting package.')
     tar = tarfile.open(args.app)
+    names = tar.getnames()
     tar.extractall()
     tar.close()
 
-    run_command('touch /tmp/p4app_logs/p4s.s1.log')
-    run_command('ln -s /tmp/p4app_logs/p4s.s1.log /tmp/p4s.s1.log')
+    entries = set(os.path.normpath(name).split(os.sep)[0] for name in names)
+    entries.discard('.')
+    return sorted(entries)
+
+def make_target_dir(target, package_entries):
+    # Give each target its own working directory, with the package's files
+    # symlinked into it, so that the files a run leaves in its working
+    # directory (pcaps, STF temporaries, ...) don't collide.
+    target_dir = os.path.join(os.getcwd(), TARGETS_DIR, target)
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+    os.makedirs(target_dir)
+    for entry in package_entries:
+        os.symlink(os.path.abspath(entry), os.path.join(target_dir, entry))
+    return target_dir
+
+def compile_targets(manifests):
+    # Compile once for each distinct compiler configuration used by the
+    # targets. Returns a map from target name to the compiled JSON file, or to
+    # None if compilation failed.
+    compile_keys = ['model', 'compiler-flags', 'run-before-compile', 'run-after-compile']
+    compiled = {}
+    json_files = {}
+    for manifest in manifests:
+        key = json.dumps([manifest.target_config.get(k) for k in compile_keys])
+        if key not in compiled:
+            log('Compiling for target', manifest.target)
+            try:
+                output_file = run_compile_bmv2(manifest)
+                json_file = os.path.join(os.getcwd(), TARGETS_DIR, 'program-%d.json' % len(compiled))
+                shutil.copyfile(output_file, json_file)
+                compiled[key] = json_file
+            except SystemExit:
+                compiled[key] = None
+        json_files[manifest.target] = compiled[key]
+    return json_files
+
+def run_targets(package_entries):
+    # Run several targets concurrently, each in its own network namespace,
+    # with its own block of Thrift ports, IPC sockets and log directory.
+    with open(args.manifest, 'r') as manifest_file:
+        manifest = load_manifest(manifest_file)
+
+    if args.all_targets:
+        targets = manifest['targets'].keys()
+    else:
+        targets = [t.strip() for t in args.targets.split(',') if t.strip()]
+    for target in targets:
+        if target not in manifest['targets']:
+            log_error('Target not found in manifest:', target)
+            sys.exit(1)
+
+    manifests = [Manifest(manifest['program'], manifest['language'], target,
+                          manifest['targets'][target]) for target in targets]
+
+    targets_dir = os.path.join(os.getcwd(), TARGETS_DIR)
+    if not os.path.isdir(targets_dir): os.makedirs(targets_dir)
+    json_files = compile_targets(manifests)
+
+    jobs, failed = [], []
+    for i, m in enumerate(manifests):
+        log_dir = os.path.join(args.log_dir, m.target)
+        if not os.path.isdir(log_dir): os.makedirs(log_dir)
+
+        if json_files[m.target] is None:
+            job = IsolatedJob(m.target, [], log_file=None)
+            job.returncode = 1
+            failed.append(job)
+            continue
+
+        target_dir = make_target_dir(m.target, package_entries)
+        argv = ['python2', os.path.join(sys.path[0], 'p4apprunner.py'),
+                '--build-dir', target_dir,
+                '--skip-extract',
+                '--manifest', args.manifest,
+                '--log-dir', log_dir,
+                '--thrift-port', str(args.thrift_port + i * THRIFT_PORT_STRIDE),
+                '--ipc-dir', target_dir,
+                '--json', json_files[m.target]]
+        if args.quiet: argv.append('--quiet')
+        argv += [args.app, m.target]
+        jobs.append(IsolatedJob(m.target, argv, cwd=target_dir,
+                                log_file=os.path.join(log_dir, 'output.log')))
+
+    def report(job):
+        status = 'PASS' if job.returncode == 0 else 'FAIL'
+        log('%s %s (%.1fs, log: %s)' % (status, job.name, job.duration(), job.log_file))
+
+    log('Running %d targets, at most %d at a time.' % (len(jobs), args.jobs))
+    results = run_isolated(jobs, args.jobs, on_done=report) + failed
+    results.sort(key=lambda job: targets.index(job.name))
+
+    summary = [job.summary() for job in results]
+    with open(os.path.join(args.log_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    log('')
+    log('%-24s %-6s %8s' % ('Target', 'Result', 'Seconds'))
+    for job in results:
+        seconds = job.duration()
+        log('%-24s %-6s %8s' % (job.name, 'PASS' if job.returncode == 0 else 'FAIL',
+                                '%.1f' % seconds if seconds is not None else '-'))
+    passed = len([job for job in results if job.returncode == 0])
+    log('%d of %d targets passed.' % (passed, len(results)))
+
+    return 0 if passed == len(results) else 1
+
+def main(argv=None):
+    global args, timings
+
+    args = parser.parse_args(argv)
+    args.app = os.path.abspath(args.app)
+
+    log('Entering build directory.')
+    os.chdir(args.build_dir)
+
+    if not os.path.isdir(args.log_dir): os.makedirs(args.log_dir)
+    timings = AppTimings(args.log_dir)
+    timings.reset()
+
+    package_entries = []
+    if not args.skip_extract:
+        with timings.phase('extract'):
+            package_entries = extract_package()
+
+    if args.all_targets or args.targets:
+        with timings.phase('targets'):
+            rc = run_targets(package_entries)
+        timings.save()
+        sys.exit(rc)
+
+    s1_log = os.path.join(args.log_dir, 'p4s.s1.log')
+    open(s1_log, 'a').close()
+    if not args.skip_extract and not args.no_log_link:
+        # A shortcut to the switch log of a single-target run. Targets run
+        # with --all-targets or --targets keep theirs in their own log dirs,
+        # and so do runs that share /tmp with others, such as p4apptest's.
+        try:
+            if os.path.islink('/tmp/p4s.s1.log'): os.remove('/tmp/p4s.s1.log')
+            if not os.path.lexists('/tmp/p4s.s1.log'):
+                os.symlink(s1_log, '/tmp/p4s.s1.log')
+        except OSError as e:
+            log_error('Not linking /tmp/p4s.s1.log:', e)
 
     log('Reading package manifest.')
     with open(args.manifest, 'r') as manifest_file:
         manifest = read_manifest(manifest_file)
 
     # Dispatch to the backend implementation for this target.
-    backend = manifest.target
-    if 'use' in manifest.target_config:
-        backend = manifest.target_config['use']
-
-    if args.build_only or backend == 'compile-bmv2':
-        build_only(manifest)
-        rc = 0
-    elif backend == 'mininet':
-        rc = run_mininet(manifest)
-    elif backend == 'multiswitch':
-        rc = run_multiswitch(manifest)
-    elif backend == 'stf':
-        rc = run_stf(manifest)
-    elif backend == 'custom':
-        rc = run_custom(manifest)
-    else:
-        log_error('Target specifies unknown backend:', backend)
-        sys.exit(1)
+    backend = get_backend(manifest)
+
+    if args.build_only: backend = 'compile-bmv2'
+
+    try:
+        with timings.phase(backend):
+            if backend == 'compile-bmv2':
+                build_only(manifest)
+                rc = 0
+            elif backend == 'mininet':
+                rc = run_mininet(manifest)
+            elif backend == 'multiswitch':
+                rc = run_multiswitch(manifest)
+            elif backend == 'stf':
+                rc = run_stf(manifest)
+            elif backend == 'cp-bench':
+                rc = run_cp_bench(manifest)
+            elif backend == 'custom':
+                rc = run_custom(manifest)
+            else:
+                log_error('Target specifies unknown backend:', backend)
+                sys.exit(1)
+    finally:
+        timings.save()
 
     sys.exit(rc)
 
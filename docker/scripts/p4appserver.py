@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A long-lived p4app runner. `serve` imports the runner and its backends once,
+# then listens on a Unix socket; `submit` sends it a package and streams back
+# the run's output and exit code. Each submission runs in a forked child of the
+# server, so it starts with everything already imported, and nothing it does
+# leaks into the next submission.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tarfile
+import tempfile
+import traceback
+
+from nsrunner import terminate
+
+# --socket is an option of each command, so that it can follow the command,
+# as it does when `p4app serve` passes its arguments on.
+socket_parser = argparse.ArgumentParser(add_help=False)
+socket_parser.add_argument('--socket', help='Path of the Unix socket to use.',
+                           type=str, action='store', required=False, default='/tmp/p4app.sock')
+
+parser = argparse.ArgumentParser(description='p4appserver')
+subparsers = parser.add_subparsers(dest='command')
+subparsers.add_parser('serve', parents=[socket_parser],
+                      help='Run p4app packages submitted over the socket.')
+submit_parser = subparsers.add_parser('submit', parents=[socket_parser],
+                                      help='Run a p4app package on the server.')
+submit_parser.add_argument('app', help=('.p4app package to run: a directory, an archive, '
+                                        'or - to read an archive from stdin.'), type=str)
+submit_parser.add_argument('runner_args', help='Arguments for p4apprunner.',
+                           nargs=argparse.REMAINDER)
+
+# Every message is a one-byte type, a four-byte length and a payload.
+MSG_ARGS = 'A'    # client -> server: JSON list of p4apprunner arguments
+MSG_DATA = 'D'    # client -> server: a chunk of the package archive
+MSG_END = 'E'     # client -> server: end of the package archive
+MSG_OUTPUT = 'O'  # server -> client: a chunk of the run's output
+MSG_EXIT = 'X'    # server -> client: the run's exit code
+
+CHUNK_SIZE = 64 * 1024
+
+def send_msg(sock, msg_type, payload=''):
+    sock.sendall(struct.pack('!cI', msg_type, len(payload)) + payload)
+
+def recv_exactly(sock, n):
+    data = []
+    while n > 0:
+        chunk = sock.recv(min(n, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError('Connection closed')
+        data.append(chunk)
+        n -= len(chunk)
+    return ''.join(data)
+
+def recv_msg(sock):
+    msg_type, length = struct.unpack('!cI', recv_exactly(sock, 5))
+    return msg_type, recv_exactly(sock, length)
+
+def preload():
+    # Import everything a run might need, so that forked children get it for
+    # free.
+    import p4apprunner
+    import multi_switch_mininet
+    import single_switch_mininet
+    import bmv2stf
+    import appcontroller
+    import appprocrunner
+    import apptopo
+    return p4apprunner
+
+def run_worker(p4apprunner, argv):
+    try:
+        p4apprunner.main(argv)
+        return 0
+    except SystemExit as e:
+        if e.code is None: return 0
+        if isinstance(e.code, int): return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def cancel(pid, reap):
+    # Mininet starts each node in a session of its own, so stop everything the
+    # worker started, not just its process group. The worker doesn't get to
+    # run net.stop(), so then remove the links and processes it left behind,
+    # which would otherwise collide with the next submission's.
+    terminate(pid, None, reap)
+    try:
+        from mininet.clean import cleanup
+        cleanup()
+    except Exception:
+        traceback.print_exc()
+
+def handle(conn, p4apprunner):
+    work_dir = tempfile.mkdtemp(prefix='p4app_submission_')
+    try:
+        msg_type, payload = recv_msg(conn)
+        if msg_type != MSG_ARGS:
+            raise Exception('Expected arguments, got message %r' % msg_type)
+        runner_args = json.loads(payload)
+
+        package = os.path.join(work_dir, 'package.tar')
+        with open(package, 'wb') as f:
+            while True:
+                msg_type, payload = recv_msg(conn)
+                if msg_type == MSG_END: break
+                if msg_type != MSG_DATA:
+                    raise Exception('Expected package data, got message %r' % msg_type)
+                f.write(payload)
+
+        build_dir = os.path.join(work_dir, 'build')
+        os.mkdir(build_dir)
+        argv = [package] + runner_args + ['--build-dir', build_dir]
+        print('Running submission:', ' '.join(runner_args))
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The worker gets its own process group, so that signals meant for
+            # the server don't reach it.
+            os.setpgrp()
+            os.close(r)
+            conn.close()
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(w, 1)
+            os.dup2(w, 2)
+            os.close(w)
+            os._exit(run_worker(p4apprunner, argv))
+
+        os.close(w)
+        exit_status = []
+        def reap():
+            if not exit_status:
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done: exit_status.append(status)
+        try:
+            while True:
+                data = os.read(r, CHUNK_SIZE)
+                if not data: break
+                send_msg(conn, MSG_OUTPUT, data)
+        except socket.error:
+            cancel(pid, reap)
+        finally:
+            os.close(r)
+
+        if exit_status: status = exit_status[0]
+        else: _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status): rc = os.WEXITSTATUS(status)
+        else: rc = 128 + os.WTERMSIG(status)
+        print('Submission finished with exit code', rc)
+        send_msg(conn, MSG_EXIT, str(rc))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def serve(socket_path):
+    print('Loading p4app runner and backends.')
+    p4apprunner = preload()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.listen(8)
+    print('Listening on', socket_path)
+
+    # Submissions run one at a time: concurrent Mininet networks in the same
+    # namespace would collide.
+    while True:
+        conn, _ = sock.accept()
+        try:
+            handle(conn, p4apprunner)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            conn.close()
+
+def send_package(sock, app):
+    if os.path.isdir(app):
+        # Stream an uncompressed archive of the directory.
+        class Writer:
+            def write(self, data):
+                send_msg(sock, MSG_DATA, data)
+        tar = tarfile.open(fileobj=Writer(), mode='w|')
+        tar.add(app, arcname='.')
+        tar.close()
+    else:
+        f = sys.stdin if app == '-' else open(app, 'rb')
+        try:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data: break
+                send_msg(sock, MSG_DATA, data)
+        finally:
+            if f is not sys.stdin: f.close()
+    send_msg(sock, MSG_END)
+
+def submit(socket_path, app, runner_args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    send_msg(sock, MSG_ARGS, json.dumps(runner_args))
+    send_package(sock, app)
+
+    while True:
+        msg_type, payload = recv_msg(sock)
+        if msg_type == MSG_OUTPUT:
+            sys.stdout.write(payload)
+            sys.stdout.flush()
+        elif msg_type == MSG_EXIT:
+            return int(payload)
+
+def main():
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.socket)
+    else:
+        sys.exit(submit(args.socket, args.app, args.runner_args))
+
+if __name__ == '__main__':
+    main()
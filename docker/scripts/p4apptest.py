@@ -0,0 +1,169 @@
+#!/usr/bin/env python2
+# Copyright 2013-present Barefoot Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs many p4app packages concurrently, each in its own network namespace and
+# build directory, and writes a JUnit XML and a JSON report of the results.
+
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+from nsrunner import IsolatedJob, run_isolated
+
+parser = argparse.ArgumentParser(description='p4apptest')
+parser.add_argument('--log-dir', help='Directory to save logs and reports to.',
+                    type=str, action='store', required=False, default='/tmp/p4app_logs')
+parser.add_argument('--build-root', help='Directory to build the packages in.',
+                    type=str, action='store', required=False, default='/tmp/p4app_test')
+parser.add_argument('--jobs', help='Maximum number of packages to run at once.',
+                    type=int, action='store', required=False,
+                    default=multiprocessing.cpu_count())
+parser.add_argument('--timeout', help='Seconds each package may run for before it is killed.',
+                    type=float, action='store', required=False, default=600)
+parser.add_argument('--all-targets', help='Run every target of each package, not just the default.',
+                    action='store_true', required=False, default=False)
+parser.add_argument('packages', help=('.p4app packages to run, or directories or glob '
+                                      'patterns to search for them.'),
+                    nargs='+', type=str)
+
+LOG_TAIL_LINES = 20
+
+def is_package(path):
+    if os.path.isdir(path):
+        return os.path.isfile(os.path.join(path, 'p4app.json'))
+    return path.endswith('.p4app') and os.path.isfile(path)
+
+def find_packages(patterns):
+    packages = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            path = os.path.normpath(path)
+            if is_package(path):
+                packages.append(path)
+            elif os.path.isdir(path):
+                packages += [p for p in sorted(glob.glob(os.path.join(path, '*.p4app')))
+                             if is_package(p)]
+            else:
+                print('No p4app package found at', path, file=sys.stderr)
+    return packages
+
+def package_names(packages):
+    # Name each package after its file name, disambiguating duplicates.
+    names, seen = [], {}
+    for path in packages:
+        name = os.path.basename(path)
+        if name.endswith('.p4app'): name = name[:-len('.p4app')]
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1: name = '%s-%d' % (name, seen[name])
+        names.append(name)
+    return names
+
+def log_tail(path, lines=LOG_TAIL_LINES):
+    if not path or not os.path.exists(path): return ''
+    with open(path, 'r') as f:
+        return ''.join(f.readlines()[-lines:])
+
+def status(job):
+    if job.timed_out: return 'TIMEOUT'
+    return 'PASS' if job.returncode == 0 else 'FAIL'
+
+def write_junit(path, jobs, seconds):
+    failures = [job for job in jobs if job.returncode != 0]
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<testsuite name="p4app" tests="%d" failures="%d" errors="0" time="%.3f">\n' %
+                (len(jobs), len(failures), seconds))
+        for job in jobs:
+            f.write('  <testcase classname="p4app" name=%s time="%.3f">\n' %
+                    (quoteattr(job.name), job.duration() or 0))
+            if job.returncode != 0:
+                if job.timed_out:
+                    message = 'Timed out after %ds' % job.timeout
+                else:
+                    message = 'Exited with code %d' % job.returncode
+                f.write('    <failure message=%s>%s</failure>\n' %
+                        (quoteattr(message), escape(log_tail(job.log_file))))
+            f.write('    <system-out>%s</system-out>\n' % escape(job.log_file or ''))
+            f.write('  </testcase>\n')
+        f.write('</testsuite>\n')
+
+def main():
+    args = parser.parse_args()
+
+    packages = find_packages(args.packages)
+    if not packages:
+        print('No p4app packages to run.', file=sys.stderr)
+        sys.exit(1)
+
+    if not os.path.isdir(args.log_dir): os.makedirs(args.log_dir)
+    runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'p4apprunner.py')
+
+    jobs = []
+    for path, name in zip(packages, package_names(packages)):
+        build_dir = os.path.join(args.build_root, name)
+        log_dir = os.path.join(args.log_dir, name)
+        if os.path.exists(build_dir): shutil.rmtree(build_dir)
+        os.makedirs(build_dir)
+        if not os.path.isdir(log_dir): os.makedirs(log_dir)
+
+        # Every package runs in its own network namespace, so they can all use
+        # the default Thrift ports; the IPC sockets go in the build directory.
+        # They share /tmp, though, so none of them links /tmp/p4s.s1.log.
+        argv = ['python2', runner,
+                '--build-dir', build_dir,
+                '--log-dir', log_dir,
+                '--ipc-dir', build_dir,
+                '--no-log-link']
+        if args.all_targets: argv.append('--all-targets')
+        argv.append(os.path.abspath(path))
+        jobs.append(IsolatedJob(name, argv, cwd=build_dir,
+                                log_file=os.path.join(log_dir, 'output.log'),
+                                timeout=args.timeout))
+
+    def report(job):
+        print('%-7s %s (%.1fs)' % (status(job), job.name, job.duration()))
+        if job.returncode != 0:
+            for line in log_tail(job.log_file).splitlines():
+                print('    ' + line)
+            print('    (full log: %s)' % job.log_file)
+        sys.stdout.flush()
+
+    print('Running %d packages, at most %d at a time.' % (len(jobs), args.jobs))
+    start = time.time()
+    results = run_isolated(jobs, args.jobs, on_done=report)
+    seconds = time.time() - start
+
+    passed = len([job for job in results if job.returncode == 0])
+    with open(os.path.join(args.log_dir, 'report.json'), 'w') as f:
+        json.dump(dict(passed=passed, failed=len(results) - passed, seconds=seconds,
+                       packages=[dict(job.summary(), package=path)
+                                 for job, path in zip(results, packages)]),
+                  f, indent=2)
+    write_junit(os.path.join(args.log_dir, 'junit.xml'), results, seconds)
+
+    print('')
+    print('%d of %d packages passed in %.1fs.' % (passed, len(results), seconds))
+    sys.exit(0 if passed == len(results) else 1)
+
+if __name__ == '__main__':
+    main()